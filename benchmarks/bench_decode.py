@@ -0,0 +1,98 @@
+# -*- coding: utf-8 -*-
+# --------------------------------------------------
+# bench_decode.py - Parse time and allocations of a messages poll.
+# Quentin Dufournet, 2023
+# --------------------------------------------------
+# Built-in
+import os
+import sys
+import json
+import timeit
+import tracemalloc
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+# Local
+from src import messages  # noqa: E402
+from benchmarks.bench_messages import fake_message  # noqa: E402
+
+# --------------------------------------------------
+
+
+def count_new_blocks(before, after):
+    """
+    The function `count_new_blocks` counts the memory blocks allocated between two
+    snapshots and still alive in the second one.
+
+    :param before: The snapshot taken first.
+    :param after: The snapshot taken last.
+    :return: the number of new blocks.
+    """
+
+    # The snapshots are traced as well, leave them out
+    ignore = [tracemalloc.Filter(False, tracemalloc.__file__)]
+    before, after = before.filter_traces(ignore), after.filter_traces(ignore)
+
+    return sum(max(0, stat.count_diff) for stat in after.compare_to(before, 'lineno'))
+
+
+def allocations(decode, payload):
+    """
+    The function `allocations` measures the memory blocks allocated by a decoding, the
+    ones still retained once its result is dropped, and the peak memory used while
+    decoding. Blocks allocated and freed within the decoding are not in the snapshots,
+    they only show in the peak.
+
+    :param decode: A callable decoding the payload.
+    :param payload: The raw payload, as bytes.
+    :return: a tuple of the number of allocated blocks, of retained blocks, and the peak
+    size in bytes.
+    """
+
+    tracemalloc.start()
+    before = tracemalloc.take_snapshot()
+    tracemalloc.reset_peak()
+    current = tracemalloc.get_traced_memory()[0]
+
+    kept = decode(payload)
+    peak = tracemalloc.get_traced_memory()[1] - current
+    allocated = count_new_blocks(before, tracemalloc.take_snapshot())
+
+    del kept
+    retained = count_new_blocks(before, tracemalloc.take_snapshot())
+    tracemalloc.stop()
+
+    return allocated, retained, peak
+
+
+def main():
+    """ Print the parse time and allocations of a 100 messages poll for each backend """
+
+    payload = json.dumps([fake_message(i) for i in range(1, 101)]).encode()
+    print(f'Payload: 100 messages, {len(payload) / 1024:.1f} KiB\n')
+
+    def decode_with(backend):
+        def decode(raw):
+            messages.JSON_BACKEND = backend
+            return messages.decode_messages(raw)
+        return decode
+
+    decoders = {'dicts (json)': json.loads, 'Message (json)': decode_with('json')}
+    if messages.orjson is not None:
+        decoders['Message (orjson)'] = decode_with('orjson')
+    if messages.msgspec is not None:
+        decoders['Message (msgspec)'] = decode_with('msgspec')
+
+    default_backend = messages.JSON_BACKEND
+    print(f'{"Decoder":20} {"ms/poll":>8} {"allocated":>10} {"retained":>9} {"peak KiB":>9}')
+    for name, decode in decoders.items():
+        runs = 200
+        duration = timeit.timeit(lambda: decode(payload), number=runs) / runs
+        allocated, retained, peak = allocations(decode, payload)
+        print(f'{name:20} {duration * 1000:8.3f} {allocated:10} {retained:9} '
+              f'{peak / 1024:9.1f}')
+    messages.JSON_BACKEND = default_backend
+
+
+if __name__ == '__main__':
+    main()
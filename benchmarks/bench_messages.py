@@ -0,0 +1,139 @@
+# -*- coding: utf-8 -*-
+# --------------------------------------------------
+# bench_messages.py - Memory benchmark of the message model.
+# Quentin Dufournet, 2023
+# --------------------------------------------------
+# Built-in
+import os
+import sys
+import copy
+import json
+import tracemalloc
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+# Local
+from src.messages import Message, MessageBuffer  # noqa: E402
+
+# --------------------------------------------------
+
+
+def fake_message(message_id, referenced=True):
+    """
+    The function `fake_message` builds a message object shaped like the ones returned by
+    the Discord API, with author, embeds, reactions and a referenced message.
+
+    :param message_id: Unique identifier of the message.
+    :param referenced: Whether the message replies to another one.
+    :return: a dict that represents the message object.
+    """
+
+    author = {
+        'id': str(80351110224678912 + message_id % 50),
+        'username': f'user{message_id % 50}',
+        'global_name': f'User {message_id % 50}',
+        'avatar': 'a_d5efa99b3eeaa7dd43acca82f5692432',
+        'discriminator': '0',
+        'public_flags': 64,
+        'avatar_decoration_data': None,
+    }
+    message = {
+        'id': str(1100000000000000000 + message_id),
+        'type': 19 if referenced else 0,
+        'content': f'Message number {message_id}, with some words to look like a real one.',
+        'channel_id': '1089226813218439210',
+        'author': author,
+        'attachments': [{
+            'id': str(1100000000000000000 + message_id),
+            'filename': 'image.png',
+            'size': 2284103,
+            'url': f'https://cdn.discordapp.com/attachments/1/{message_id}/image.png',
+            'proxy_url': f'https://media.discordapp.net/attachments/1/{message_id}/image.png',
+            'width': 4032,
+            'height': 3024,
+            'content_type': 'image/png',
+        }] if message_id % 5 == 0 else [],
+        'embeds': [{
+            'type': 'link',
+            'url': 'https://github.com/mcxiv/10cord',
+            'title': 'GitHub - mcxiv/10cord',
+            'description': 'A Discord client, entirely in your terminal.',
+            'thumbnail': {
+                'url': 'https://opengraph.githubassets.com/10cord',
+                'proxy_url': 'https://images-ext-1.discordapp.net/external/10cord',
+                'width': 1200,
+                'height': 600,
+            },
+        }] if message_id % 3 == 0 else [],
+        'mentions': [copy.deepcopy(author)],
+        'mention_roles': [],
+        'pinned': False,
+        'mention_everyone': False,
+        'tts': False,
+        'timestamp': '2023-09-12T15:04:01.516000+00:00',
+        'edited_timestamp': None,
+        'flags': 0,
+        'components': [],
+        'reactions': [{
+            'emoji': {'id': None, 'name': '👍'},
+            'count': 2,
+            'count_details': {'burst': 0, 'normal': 2},
+            'burst_colors': [],
+            'me_burst': False,
+            'burst_me': False,
+            'me': False,
+            'burst_count': 0,
+        }],
+    }
+    if referenced:
+        message['message_reference'] = {
+            'channel_id': message['channel_id'],
+            'message_id': str(1100000000000000000 + message_id - 1),
+        }
+        message['referenced_message'] = fake_message(message_id - 1, referenced=False)
+
+    return message
+
+
+def measure(build):
+    """
+    The function `measure` returns the memory retained by the object built by `build`.
+
+    :param build: A callable building the object to measure.
+    :return: the retained size in bytes.
+    """
+
+    tracemalloc.start()
+    kept = build()
+    size = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    del kept
+
+    return size
+
+
+def main():
+    """ Print the memory used by dicts and by the compact model, then by a long session """
+
+    count = 100
+    raw = json.dumps([fake_message(i) for i in range(1, count + 1)])
+
+    dict_size = measure(lambda: json.loads(raw))
+    model_size = measure(lambda: [Message.from_dict(message) for message in json.loads(raw)])
+    print(f'{count} messages as dicts   : {dict_size / 1024:8.1f} KiB')
+    print(f'{count} messages as Message : {model_size / 1024:8.1f} KiB')
+
+    # A busy channel: a few new messages on every poll. A week of polling every
+    # 3 seconds is about 200000 polls, the buffer stops growing long before.
+    def session(polls):
+        buffer = MessageBuffer()
+        for poll in range(polls):
+            buffer.extend(Message.from_dict(fake_message(poll * 3 + i)) for i in range(3))
+        return buffer
+
+    for polls in (100, 1000, 10000):
+        print(f'Buffer after {polls:6} polls : {measure(lambda: session(polls)) / 1024:8.1f} KiB')
+
+
+if __name__ == '__main__':
+    main()
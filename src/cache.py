@@ -0,0 +1,196 @@
+# -*- coding: utf-8 -*-
+# --------------------------------------------------
+# cache.py - Persistent, size-bounded cache of attachments.
+# Quentin Dufournet, 2023
+# --------------------------------------------------
+# Built-in
+import os
+import time
+import sqlite3
+import hashlib
+import tempfile
+import threading
+from urllib.parse import urlsplit, parse_qsl, urlencode
+
+# --------------------------------------------------
+
+# Signature parameters of Discord CDN links, they change while the file does not
+SIGNATURE_PARAMS = ('ex', 'is', 'hm')
+
+
+def url_key(url):
+    """
+    The function `url_key` returns the part of an attachment URL identifying its content,
+    without the signature parameters.
+
+    :param url: The `url` parameter is the URL of the attachment
+    :return: the key of the URL.
+    """
+
+    parts = urlsplit(url)
+    params = sorted((name, value) for name, value in parse_qsl(parts.query)
+                    if name not in SIGNATURE_PARAMS)
+
+    return f'{parts.netloc}{parts.path}?{urlencode(params)}'
+
+
+class AttachmentCache():
+    """
+    Content-addressed cache of attachments on disk. Files are stored by the SHA-256 of
+    their content, and evicted least recently used first once the cache exceeds its
+    byte budget. The index is an SQLite database, so several 10cord processes can
+    share the cache.
+    """
+
+    def __init__(self, directory, max_bytes):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.bytes_saved = 0
+
+        os.makedirs(os.path.join(directory, 'objects'), exist_ok=True)
+
+        self.connection = sqlite3.connect(
+            os.path.join(directory, 'index.db'), timeout=10, check_same_thread=False,
+            isolation_level=None
+        )
+        self.connection.execute('PRAGMA journal_mode=WAL')
+        self.connection.execute(
+            'CREATE TABLE IF NOT EXISTS blobs '
+            '(hash TEXT PRIMARY KEY, size INTEGER, accessed REAL)')
+        self.connection.execute(
+            'CREATE TABLE IF NOT EXISTS urls (key TEXT PRIMARY KEY, hash TEXT)')
+
+    def path(self, digest):
+        """
+        The function `path` returns where a file is stored.
+
+        :param digest: The SHA-256 of the file content
+        :return: the path of the file.
+        """
+
+        return os.path.join(self.directory, 'objects', digest[:2], digest)
+
+    def get(self, url, download):
+        """
+        The function `get` returns the cached copy of an attachment, downloading it on a
+        miss.
+
+        :param url: The `url` parameter is the URL of the attachment
+        :param download: A callable downloading a URL, returning its content or None
+        :return: the path of the cached file, or None if it could not be downloaded.
+        """
+
+        key = url_key(url)
+
+        with self.lock:
+            row = self.connection.execute(
+                'SELECT blobs.hash, blobs.size FROM urls JOIN blobs ON urls.hash = blobs.hash '
+                'WHERE urls.key = ?', (key,)
+            ).fetchone()
+            if row and os.path.exists(self.path(row[0])):
+                self.connection.execute(
+                    'UPDATE blobs SET accessed = ? WHERE hash = ?', (time.time(), row[0]))
+                self.hits += 1
+                self.bytes_saved += row[1]
+                return self.path(row[0])
+
+        content = download(url)
+        if content is None:
+            return None
+
+        digest = hashlib.sha256(content).hexdigest()
+        path = self.path(digest)
+        if not os.path.exists(path):
+            # Write then rename, so other processes never see a partial file
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            descriptor, temporary = tempfile.mkstemp(dir=os.path.dirname(path))
+            with os.fdopen(descriptor, 'wb') as f:
+                f.write(content)
+            os.replace(temporary, path)
+
+        with self.lock:
+            self.misses += 1
+            self.connection.execute('BEGIN IMMEDIATE')
+            try:
+                self.connection.execute(
+                    'INSERT OR REPLACE INTO blobs (hash, size, accessed) VALUES (?, ?, ?)',
+                    (digest, len(content), time.time()))
+                self.connection.execute(
+                    'INSERT OR REPLACE INTO urls (key, hash) VALUES (?, ?)', (key, digest))
+                evicted = self.evict(keep=digest)
+                self.connection.execute('COMMIT')
+            except BaseException:
+                # Never leave the transaction open, it would lock the index of
+                # every 10cord sharing the cache
+                self.connection.execute('ROLLBACK')
+                raise
+
+        # Removed once the index no longer references them
+        for digest in evicted:
+            try:
+                os.remove(self.path(digest))
+            except OSError:
+                pass
+
+        return path
+
+    def evict(self, keep):
+        """
+        The function `evict` removes the least recently used files from the index until
+        the cache fits in its byte budget. Must be called inside a transaction.
+
+        :param keep: The SHA-256 of a file that must not be evicted
+        :return: the SHA-256 of the evicted files, to remove from the disk once the
+        transaction is committed.
+        """
+
+        evicted = []
+        total = self.connection.execute(
+            'SELECT COALESCE(SUM(size), 0) FROM blobs').fetchone()[0]
+        if total <= self.max_bytes:
+            return evicted
+
+        for digest, size in self.connection.execute(
+                'SELECT hash, size FROM blobs WHERE hash != ? ORDER BY accessed',
+                (keep,)).fetchall():
+            self.connection.execute('DELETE FROM blobs WHERE hash = ?', (digest,))
+            self.connection.execute('DELETE FROM urls WHERE hash = ?', (digest,))
+            evicted.append(digest)
+
+            total -= size
+            if total <= self.max_bytes:
+                break
+
+        return evicted
+
+    def stats(self):
+        """
+        The function `stats` reports the efficiency of the cache during this session.
+
+        :return: a dict with the hits, misses, hit rate, bytes saved, and the number of
+        files and bytes stored.
+        """
+
+        with self.lock:
+            count, size = self.connection.execute(
+                'SELECT COUNT(*), COALESCE(SUM(size), 0) FROM blobs').fetchone()
+
+        requests = self.hits + self.misses
+
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_rate': self.hits / requests if requests else 0,
+            'bytes_saved': self.bytes_saved,
+            'files': count,
+            'bytes': size,
+        }
+
+    def close(self):
+        """ Close the index """
+
+        with self.lock:
+            self.connection.close()
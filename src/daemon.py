@@ -0,0 +1,386 @@
+# -*- coding: utf-8 -*-
+# --------------------------------------------------
+# daemon.py - Background sync daemon and its thin frontends.
+# Quentin Dufournet, 2023
+# --------------------------------------------------
+# Built-in
+import os
+import json
+import time
+import queue
+import socket
+import threading
+
+# 3rd party
+from rich import print as rprint
+
+# Local
+from .messages import Message
+
+# --------------------------------------------------
+
+POLL_INTERVAL = 3
+
+
+def encode_update(channel, new, edited, deleted):
+    """
+    The function `encode_update` builds the event pushed to the frontends when the
+    messages of a channel change.
+
+    :param channel: Unique identifier of the channel.
+    :param new: A list of new `Message`
+    :param edited: A list of edited `Message`
+    :param deleted: A list of deleted `Message`
+    :return: a dict that represents the event.
+    """
+
+    return {
+        'event': 'messages',
+        'channel': channel,
+        'new': [message.to_dict() for message in new],
+        'edited': [message.to_dict() for message in edited],
+        'deleted': [message.id for message in deleted],
+    }
+
+
+def encode_snapshot(channel, messages):
+    """
+    The function `encode_snapshot` builds the event sending the buffer of a channel to
+    a frontend that subscribes. Deleted messages are left out, the frontend starts from
+    an empty buffer and would take them for live ones.
+
+    :param channel: Unique identifier of the channel.
+    :param messages: The buffered `Message` of the channel, oldest first
+    :return: a dict that represents the event.
+    """
+
+    return encode_update(
+        channel, [message for message in messages if not message.deleted], [], [])
+
+
+class Frontend():
+    """ A frontend connected to the daemon """
+
+    def __init__(self, connection):
+        self.connection = connection
+        self.lock = threading.Lock()
+
+    def send(self, event):
+        """
+        The function `send` writes an event to the frontend, as a line of JSON.
+
+        :param event: The `event` parameter is a dict that represents the event
+        :return: False if the frontend is gone.
+        """
+
+        try:
+            with self.lock:
+                self.connection.sendall(json.dumps(event).encode() + b'\n')
+        except OSError:
+            return False
+
+        return True
+
+
+class Daemon():
+    """
+    Holds one authenticated session and performs all the API traffic. Frontends attach
+    over a Unix socket, subscribe to channels, and receive the changes of their
+    channels. Each subscribed channel is polled once, whatever the number of frontends.
+    """
+
+    def __init__(self, client):
+        self.client = client
+        self.path = client.args.socket
+        self.lock = threading.Lock()
+        self.users_lock = threading.Lock()
+        self.subscriptions = {}
+
+    def serve(self):
+        """ Fetch the metadata once, then accept frontends until interrupted """
+
+        if DaemonConnection.connect(self.path):
+            raise Exception(f'A daemon is already listening on {self.path}')
+        if os.path.exists(self.path):
+            os.remove(self.path)
+
+        self.client.list_friends()
+        self.client.rprint_friends()
+        self.client.list_guilds()
+        self.client.rprint_guilds()
+
+        server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        server.bind(self.path)
+        os.chmod(self.path, 0o600)
+        server.listen()
+
+        threading.Thread(target=self.poll_loop, daemon=True).start()
+        rprint(f'[#7289DA]10cord daemon listening on {self.path}[/#7289DA]')
+
+        try:
+            while 1:
+                connection, _ = server.accept()
+                threading.Thread(
+                    target=self.handle, args=(Frontend(connection),), daemon=True
+                ).start()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            server.close()
+            os.remove(self.path)
+            self.client.search_index.close()
+
+    def fetch(self, channel):
+        """
+        The function `fetch` gets the latest messages of a channel and reconciles them
+        with the channel buffer.
+
+        :param channel: Unique identifier of the channel.
+        :return: a tuple of the new, edited and deleted messages.
+        """
+
+        messages = self.client.get_messages(channel)
+
+        with self.client.buffers_lock:
+            new, edited, deleted = self.client.get_buffer(channel).reconcile(messages)
+
+        self.client.search_index.add(new + edited)
+        self.client.search_index.remove(deleted)
+
+        return new, edited, deleted
+
+    def broadcast(self, channel, new, edited, deleted):
+        """
+        The function `broadcast` pushes the changes of a channel to its subscribers.
+
+        :param channel: Unique identifier of the channel.
+        :param new: A list of new `Message`
+        :param edited: A list of edited `Message`
+        :param deleted: A list of deleted `Message`
+        """
+
+        if not (new or edited or deleted):
+            return
+
+        event = encode_update(channel, new, edited, deleted)
+        with self.lock:
+            frontends = list(self.subscriptions.get(channel, ()))
+
+        for frontend in frontends:
+            if not frontend.send(event):
+                self.unsubscribe(frontend)
+
+    def poll_loop(self):
+        """ Poll every subscribed channel, once per interval """
+
+        while 1:
+            started = time.time()
+
+            with self.lock:
+                channels = [channel for channel, frontends in self.subscriptions.items()
+                            if frontends]
+
+            for channel in channels:
+                try:
+                    self.broadcast(channel, *self.fetch(channel))
+                except Exception as e:
+                    rprint(f'[bold][red]{e}[/red][/bold]')
+
+            time.sleep(max(0, POLL_INTERVAL - (time.time() - started)))
+
+    def unsubscribe(self, frontend, channel=None):
+        """
+        The function `unsubscribe` removes a frontend from the subscribers of a channel,
+        or of every channel.
+
+        :param frontend: The `frontend` parameter is a `Frontend`
+        :param channel: Unique identifier of the channel, None for every channel.
+        """
+
+        with self.lock:
+            for subscribed, frontends in self.subscriptions.items():
+                if channel is None or subscribed == channel:
+                    frontends.discard(frontend)
+
+    def handle(self, frontend):
+        """
+        The function `handle` answers the requests of a frontend until it disconnects.
+
+        :param frontend: The `frontend` parameter is a `Frontend`
+        """
+
+        try:
+            for line in frontend.connection.makefile('r', encoding='utf-8'):
+                request = {}
+                try:
+                    request = json.loads(line)
+                    reply = self.answer(frontend, request)
+                except Exception as e:
+                    reply = {'event': 'error', 'error': str(e)}
+                # Echo the ID of the request, so the frontend matches its reply
+                reply['id'] = request.get('id')
+                frontend.send(reply)
+        except OSError:
+            pass
+        finally:
+            self.unsubscribe(frontend)
+            frontend.connection.close()
+
+    def answer(self, frontend, request):
+        """
+        The function `answer` executes a request of a frontend.
+
+        :param frontend: The `frontend` parameter is a `Frontend`
+        :param request: The `request` parameter is a dict that represents the request
+        :return: the reply to send to the frontend.
+        """
+
+        op = request['op']
+
+        if op == 'hello':
+            return {
+                'event': 'hello',
+                'user_id': self.client.user_id,
+                'headers': self.client.headers,
+                'friends': self.client.friends,
+                'guilds': self.client.guilds,
+            }
+
+        elif op == 'subscribe':
+            channel = request['channel']
+            with self.client.buffers_lock:
+                warm = len(self.client.get_buffer(channel)) > 0
+            if not warm:
+                self.broadcast(channel, *self.fetch(channel))
+            with self.lock, self.client.buffers_lock:
+                self.subscriptions.setdefault(channel, set()).add(frontend)
+                snapshot = encode_snapshot(channel, self.client.get_buffer(channel))
+            frontend.send(snapshot)
+            return {'event': 'subscribed'}
+
+        elif op == 'unsubscribe':
+            self.unsubscribe(frontend, request['channel'])
+            return {'event': 'unsubscribed'}
+
+        elif op == 'user':
+            with self.users_lock:
+                if request['user_id'] not in self.client.ids:
+                    self.client.ids[request['user_id']] = self.client.get_username_from_id(
+                        request['user_id'])
+                username = self.client.ids[request['user_id']]
+            return {'event': 'user', 'username': username}
+
+        elif op == 'send':
+            message = self.client.post_message(
+                request['channel'], request['content'], request.get('attachments', []))
+            self.broadcast(request['channel'], *self.fetch(request['channel']))
+            return {'event': 'sent', 'message': message}
+
+        else:
+            raise Exception(f'Unknown request : {op}')
+
+
+class DaemonConnection():
+    """ Connection of a frontend to the daemon """
+
+    def __init__(self, connection):
+        self.connection = connection
+        self.lock = threading.Lock()
+        self.replies = queue.Queue()
+        self.updates = queue.Queue()
+        self.last_id = 0
+
+        threading.Thread(target=self.read_loop, daemon=True).start()
+
+    @classmethod
+    def connect(cls, path):
+        """
+        The function `connect` attaches to the daemon listening on a Unix socket.
+
+        :param path: Path of the Unix socket.
+        :return: a `DaemonConnection`, or None if no daemon is listening.
+        """
+
+        if not os.path.exists(path):
+            return None
+
+        connection = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            connection.connect(path)
+        except OSError:
+            connection.close()
+            return None
+
+        return cls(connection)
+
+    def read_loop(self):
+        """ Dispatch the events sent by the daemon, until it disconnects """
+
+        for line in self.connection.makefile('r', encoding='utf-8'):
+            event = json.loads(line)
+            if event['event'] == 'messages':
+                self.updates.put(event)
+            else:
+                self.replies.put(event)
+
+        self.updates.put({'event': 'closed'})
+        self.replies.put({'event': 'closed'})
+
+    def request(self, op, **kwargs):
+        """
+        The function `request` sends a request to the daemon and waits for its reply.
+
+        :param op: The `op` parameter is the name of the request
+        :return: the reply of the daemon.
+        """
+
+        with self.lock:
+            self.last_id += 1
+            request_id = self.last_id
+            self.connection.sendall(
+                json.dumps(dict(op=op, id=request_id, **kwargs)).encode() + b'\n')
+
+            deadline = time.time() + 30
+            while 1:
+                try:
+                    reply = self.replies.get(timeout=max(0, deadline - time.time()))
+                except queue.Empty:
+                    reply = {'event': 'error', 'error': 'Daemon did not answer'}
+                    break
+                if reply['event'] == 'closed':
+                    # Let the following requests fail as well
+                    self.replies.put(reply)
+                    reply = {'event': 'error', 'error': 'Daemon connection lost'}
+                    break
+                # Late replies to requests that timed out are dropped
+                if reply.get('id') == request_id:
+                    break
+
+        if reply['event'] == 'error':
+            raise Exception(f'Daemon {op} failed : {reply["error"]}')
+
+        return reply
+
+    def next_update(self, timeout):
+        """
+        The function `next_update` waits for the next change pushed by the daemon.
+
+        :param timeout: The maximum time to wait, in seconds
+        :return: a tuple of the channel and of the new, edited and deleted messages, or
+        None if nothing changed. The channel is None once the daemon is gone.
+        """
+
+        try:
+            event = self.updates.get(timeout=timeout)
+        except queue.Empty:
+            return None
+
+        if event['event'] == 'closed':
+            return None, [], [], []
+
+        return (
+            event['channel'],
+            [Message.from_dict(message) for message in event['new']],
+            [Message.from_dict(message) for message in event['edited']],
+            event['deleted'],
+        )
@@ -10,6 +10,9 @@ import time
 import argparse
 import threading
 import sys
+import shlex
+import shutil
+import sqlite3
 import subprocess as sp
 
 # 3rd party
@@ -17,9 +20,33 @@ from emoji import EMOJI_DATA
 import requests
 import fake_useragent
 from rich import print as rprint
+from rich.markup import escape
+
+# Local
+from .messages import (
+    MessageBuffer, BoundedDict, decode_messages,
+    CHANNEL_BUFFER_COUNT, USER_CACHE_SIZE, ATTACHMENT_CACHE_SIZE, RENDER_CACHE_SIZE
+)
+from .search import SearchIndex, HIGHLIGHT_START, HIGHLIGHT_END
+from .daemon import Daemon, DaemonConnection
+from .prefetch import Prefetcher
+from .cache import AttachmentCache
 
 # --------------------------------------------------
 
+# Size of the attachments previews, in terminal cells, and of a cell, in pixels
+PREVIEW_SIZE = 50
+CELL_WIDTH = 8
+CELL_HEIGHT = 16
+
+
+class APIError(Exception):
+    """ Failed request to the Discord API, with the status code of the response """
+
+    def __init__(self, message, status_code):
+        super().__init__(message)
+        self.status_code = status_code
+
 
 def parse_args():
     """
@@ -33,11 +60,15 @@ def parse_args():
     parser = argparse.ArgumentParser()
     parser.add_argument(
         'email',
-        help='User email',
+        help='User email (Not needed when a daemon is running)',
+        nargs='?',
+        default=None
     )
     parser.add_argument(
         'password',
-        help='User password',
+        help='User password (Not needed when a daemon is running)',
+        nargs='?',
+        default=None
     )
     parser.add_argument(
         '-c', '--channel',
@@ -54,8 +85,35 @@ def parse_args():
         help='Custom user token',
         default=None
     )
+    parser.add_argument(
+        '--cache-dir',
+        help='Directory of the persistent caches (search index, attachments, ...)',
+        default=os.path.join(
+            os.environ.get('XDG_CACHE_HOME', os.path.expanduser('~/.cache')), '10cord'
+        )
+    )
+    parser.add_argument(
+        '--cache-size',
+        help='Maximum size of the attachments cache, in MiB',
+        type=int,
+        default=256
+    )
+    parser.add_argument(
+        '-d', '--daemon',
+        help='Run as a background daemon serving 10cord frontends',
+        action='store_true'
+    )
+    parser.add_argument(
+        '--socket',
+        help='Unix socket of the daemon (Default: CACHE_DIR/daemon.sock)',
+        default=None
+    )
+
+    args = parser.parse_args()
+    if not args.socket:
+        args.socket = os.path.join(args.cache_dir, 'daemon.sock')
 
-    return parser.parse_args()
+    return args
 
 
 class MyClient():
@@ -66,7 +124,17 @@ class MyClient():
         if not os.path.exists('tmp'):
             os.mkdir('tmp')
 
-        if not self.args.token:
+        # Attach to the daemon if one is running, it already holds the session
+        self.daemon = None if self.args.daemon else DaemonConnection.connect(
+            self.args.socket)
+
+        if self.daemon:
+            hello = self.daemon.request('hello')
+            self.user_id = hello['user_id']
+            self.headers = hello['headers']
+            self.friends = hello['friends']
+            self.guilds = hello['guilds']
+        elif not self.args.token:
             if os.path.exists('tmp/token.json'):
                 with open('tmp/token.json', 'r', encoding='utf-8') as f:
                     data = json.load(f)
@@ -78,16 +146,32 @@ class MyClient():
             else:
                 self.login()
 
-        self.headers = {
-            'User-Agent': fake_useragent.UserAgent().random,
-            'Authorization': self.args.token if self.args.token else self.token
-        }
-
-        if self.args.token:
-            self.user_id = self.get_my_id()
-
-        self.ids = {}
-        self.attachments = []
+        if not self.daemon:
+            self.headers = {
+                'User-Agent': fake_useragent.UserAgent().random,
+                'Authorization': self.args.token if self.args.token else self.token
+            }
+
+            if self.args.token:
+                self.user_id = self.get_my_id()
+
+        self.ids = BoundedDict(USER_CACHE_SIZE)
+        self.attachments = BoundedDict(ATTACHMENT_CACHE_SIZE)
+        self.shown_attachments = BoundedDict(ATTACHMENT_CACHE_SIZE)
+        self.buffers = BoundedDict(CHANNEL_BUFFER_COUNT)
+        # Held while a buffer is changed, the prefetch thread fills them as well
+        self.buffers_lock = threading.Lock()
+        self.rendered = BoundedDict(RENDER_CACHE_SIZE)
+        self.messages = MessageBuffer()
+
+        os.makedirs(self.args.cache_dir, exist_ok=True)
+        self.search_index = SearchIndex(
+            os.path.join(self.args.cache_dir, 'search.db'))
+        self.prefetcher = Prefetcher(self)
+        self.attachment_cache = AttachmentCache(
+            os.path.join(self.args.cache_dir, 'attachments'),
+            self.args.cache_size * 1024 * 1024
+        )
 
     def get_my_id(self):
         """
@@ -116,6 +200,9 @@ class MyClient():
         successful, saves the user ID, token, and timestamp to a JSON file.
         """
 
+        if not self.args.email or not self.args.password:
+            sys.exit('Email and password are required when no daemon is running')
+
         data = {
             'login': self.args.email,
             'password': self.args.password,
@@ -142,12 +229,13 @@ class MyClient():
             json.dump({'user_id': self.user_id, 'token': self.token,
                       'timestamp': self.timestamp}, f, indent=4)
 
-    def get_messages(self):
+    def get_messages(self, channel=None):
         """
         The function `get_messages` retrieves the latest 100 messages from a specified
         channel using the Discord API.
 
-        :return: a list of messages.
+        :param channel: Unique identifier of the channel, the current one by default.
+        :return: a list of `Message`, oldest first.
         """
 
         params = {
@@ -155,21 +243,38 @@ class MyClient():
         }
 
         response = requests.get(
-            f'{self.url}/channels/{self.args.channel}/messages',
+            f'{self.url}/channels/{channel or self.args.channel}/messages',
             params=params,
             headers=self.headers,
             timeout=5
         )
 
         if response.status_code != 200:
-            raise Exception(
-                f'Get messages failed : {response.status_code} {response.text}')
+            raise APIError(
+                f'Get messages failed : {response.status_code} {response.text}',
+                response.status_code
+            )
 
-        messages = response.json()
+        messages = decode_messages(response.content)
         messages.reverse()
 
         return messages
 
+    def get_buffer(self, channel):
+        """
+        The function `get_buffer` returns the message buffer of a channel, creating it if
+        needed. Only the most recently used channels keep their buffer. Must be called
+        with `buffers_lock` held.
+
+        :param channel: Unique identifier of a channel.
+        :return: the `MessageBuffer` of the channel.
+        """
+
+        if channel not in self.buffers:
+            self.buffers[channel] = MessageBuffer()
+
+        return self.buffers[channel]
+
     def manage_mentions(self, content):
         """
         The function `manage_mentions` replaces user mentions, the
@@ -200,100 +305,278 @@ class MyClient():
         return content
 
     def manage_attachments(self, content, message):
-        """ Manage attachments in a message (Download, display, etc.)
+        """ Manage attachments in a message (Append the URL of the attachment)
 
         :param content: The `content` parameter is a string that
         represents the content of a message
-        :param message: The `message` parameter is a dict that
-        represents the message object
+        :param message: The `message` parameter is a `Message`
         :return: the modified content after managing attachments.
         """
 
-        if message['attachments'] != []:
+        if message.attachments:
+            attachment = message.attachments[0]
             content += (
-                f'[bold][red]{message["attachments"][0]["url"]}[/red][/bold]'
+                f'[bold][red]{attachment.url}[/red][/bold]'
             ) if content == '' else (
-                f'\n[bold][red]{message["attachments"][0]["url"]}[/red][/bold]'
+                f'\n[bold][red]{attachment.url}[/red][/bold]'
             )
 
-            if message['attachments'][0]['url'] not in self.attachments:
-                if self.args.attach:
-                    file = requests.get(
-                        message['attachments'][0]['url'], headers=self.headers
-                    )
-                    if file.status_code == 200:
-                        with open(f'./tmp/{message["attachments"][0]["filename"]}', 'wb') as f:
-                            f.write(file.content)
-                        self.attachments.append(
-                            message['attachments'][0]['url']
-                        )
-
         return content
 
+    def load_attachment(self, message):
+        """
+        The function `load_attachment` makes the attachment of a message available to
+        `:dl`, and downloads its preview unless it already was.
+
+        :param message: The `message` parameter is a `Message`
+        """
+
+        if not message.attachments:
+            return
+
+        attachment = message.attachments[0]
+        self.shown_attachments[attachment.url] = attachment
+
+        if attachment.url not in self.attachments and self.args.attach:
+            # Only a preview sized for the terminal is downloaded, see `:dl`
+            columns, rows = self.preview_size()
+            preview_url = attachment.preview_url(
+                columns * CELL_WIDTH, rows * CELL_HEIGHT)
+            if preview_url:
+                try:
+                    path = self.attachment_cache.get(
+                        preview_url, self.download_attachment)
+                except sqlite3.OperationalError:
+                    # Cache busy in another 10cord, retried on the next render
+                    path = None
+                if path:
+                    self.attachments[attachment.url] = path
+
+    def preview_size(self):
+        """
+        The function `preview_size` returns the size of the attachments previews, fitting
+        in the terminal.
+
+        :return: a tuple of the number of columns and rows of the preview.
+        """
+
+        return min(PREVIEW_SIZE, shutil.get_terminal_size().columns), PREVIEW_SIZE
+
+    def download_original(self, url):
+        """
+        The function `download_original` downloads the original file of an attachment into
+        the current directory.
+
+        :param url: The `url` parameter is the URL of an attachment displayed by 10cord
+        """
+
+        # Only attachments we displayed, the token must not be sent anywhere else
+        attachment = self.shown_attachments.get(url.strip())
+        if attachment is None:
+            rprint('[bold][red]Unknown attachment, copy its URL from a message[/red][/bold]')
+            return
+
+        content = self.download_attachment(attachment.url)
+        if content is None:
+            rprint('[bold][red]Download failed[/red][/bold]')
+            return
+
+        # Never overwrite an existing file, number the copies instead
+        name, extension = os.path.splitext(
+            os.path.basename(attachment.filename) or 'attachment')
+        filename = f'{name}{extension}'
+        copy = 0
+        while 1:
+            try:
+                with open(filename, 'xb') as f:
+                    f.write(content)
+                break
+            except FileExistsError:
+                copy += 1
+                filename = f'{name}_{copy}{extension}'
+            except OSError as e:
+                rprint(f'[bold][red]Could not save {filename} : {e}[/red][/bold]')
+                return
+
+        rprint(f'[bold][green]Saved to {os.path.abspath(filename)}[/green][/bold]')
+
+    def download_attachment(self, url):
+        """
+        The function `download_attachment` downloads an attachment.
+
+        :param url: The `url` parameter is the URL of the attachment
+        :return: the content of the attachment, or None if the download failed.
+        """
+
+        try:
+            file = requests.get(url, headers=self.headers, timeout=30)
+        except requests.RequestException:
+            return None
+
+        if file.status_code != 200:
+            return None
+
+        return file.content
+
     def manage_referenced_message(self, content, message):
         """ Manage referenced message in a message
 
         :param content: The `content` parameter is a string that
         represents the content of a message
-        :param message: The `message` parameter is a dict that
-        represents the message object
+        :param message: The `message` parameter is a `Message`
         :return: the modified content after managing referenced message.
         """
 
-        try:
-            referenced_message = message['referenced_message']['content']
-            referenced_message = self.manage_mentions(referenced_message)
-            referenced_message = self.manage_attachments(
-                referenced_message, message['referenced_message'])
-            content += f'\n> [italic]{referenced_message}[/italic]'
-        except KeyError:
-            referenced_message = None
+        if message.referenced:
+            # Prefer the buffered version, it is up to date with edits
+            referenced_message = self.messages.get(
+                message.referenced.id) or message.referenced
+            content += f'\n> [italic]{self.render_content(referenced_message)}[/italic]'
 
         return content
 
-    def print_messages(self, messages):
+    def render_content(self, message):
+        """
+        The function `render_content` renders the content of a message, with its
+        mentions and attachments. Renders are memoized by message ID and edition, so
+        mentions are looked up only once. Attachments are loaded on every render, so a
+        failed preview download is retried.
+
+        :param message: The `message` parameter is a `Message`
+        :return: the rendered content.
+        """
+
+        key = (message.id, message.edited_timestamp)
+        content = self.rendered.get(key)
+
+        if content is None:
+            content = self.manage_mentions(message.content)
+            content = self.manage_attachments(content, message)
+            self.rendered[key] = content
+
+        self.load_attachment(message)
+
+        return content
+
+    def print_messages(self, messages, previews=True):
         """
         The function "print_messages" takes in a list of messages and prints them.
 
         :param messages: The "messages" parameter is a list of messages that you want to
         print
+        :param previews: Whether attachments should be displayed with chafa
         """
 
         for message in messages:
-            date = message['timestamp'].replace('T', ' - ').split('.')[0]
-            username = message['author']['username']
-            content = message['content']
-            content = self.manage_mentions(content)
-            content = self.manage_attachments(content, message)
+            date = message.timestamp.replace('T', ' - ').split('.')[0]
+            username = message.username
+            content = self.render_content(message)
             content = self.manage_referenced_message(content, message)
 
+            if message.deleted:
+                state = ' [red](deleted)[/red]'
+            elif message.edited_timestamp:
+                state = ' [yellow](edited)[/yellow]'
+            else:
+                state = ''
+
             rprint(
-                f'[bold][blue][{date}][/blue] [magenta]{username}[/magenta][/bold] : {content}')
+                f'[bold][blue][{date}][/blue] [magenta]{username}[/magenta][/bold]{state} : {content}')
 
-            if message['attachments'] != [] and self.args.attach:
-                if os.name == 'posix' and 'Chafa version' in sp.getoutput('chafa --version'):
+            if message.attachments and self.args.attach and previews and not message.deleted:
+                path = self.attachments.get(message.attachments[0].url)
+                if path and os.name == 'posix' and 'Chafa version' in sp.getoutput('chafa --version'):
+                    columns, rows = self.preview_size()
                     os.system(
-                        f'chafa ./tmp/{message["attachments"][0]["filename"]} --size=50x50 --animate=off'
+                        f'chafa {shlex.quote(path)} --size={columns}x{rows} --animate=off'
                     )
 
-    def diff_messages(self, messages1, messages2):
+    def update_messages(self, messages):
+        """
+        The function `update_messages` reconciles freshly fetched messages with the
+        current channel buffer, and prints only what changed: new messages, edited
+        messages and deleted messages.
+
+        :param messages: A list of the latest messages of the channel, oldest first
+        """
+
+        with self.buffers_lock:
+            new, edited, deleted = self.messages.reconcile(messages)
+        self.print_update(new, edited, deleted)
+
+        self.search_index.add(new + edited)
+        self.search_index.remove(deleted)
+
+    def print_update(self, new, edited, deleted):
         """
-        The function `diff_messages` takes two lists of messages and returns a new list
-        containing messages that are in the first list but not in the second list.
+        The function `print_update` prints the changes of the current channel.
 
-        :param messages1: A list of messages
-        :param messages2: An other list of messages
+        :param new: A list of new messages
+        :param edited: A list of edited messages
+        :param deleted: A list of deleted messages
+        """
 
-        :return: a list of messages that are present in `messages1` but not in `messages2`.
+        self.print_messages(new)
+        self.print_messages(edited, previews=False)
+        self.print_messages(deleted, previews=False)
+
+    def search_messages(self, query):
         """
+        The function `search_messages` searches the local index of seen messages, across
+        every channel, and prints the best matches.
 
-        return [message for message in messages1 if message not in messages2]
+        :param query: The `query` parameter is the text to search for
+        """
+
+        started = time.time()
+        results = self.search_index.search(query)
+        elapsed = (time.time() - started) * 1000
+
+        channels = {friend['id']: friend['recipients'][0]['username']
+                    for friend in getattr(self, 'friends', [])}
+        for guild in getattr(self, 'guilds', []):
+            for channel in guild.get('channels', []):
+                channels[channel['id']] = f'{guild["name"]} #{channel["name"]}'
+
+        rprint(
+            f'[#7289DA]{len(results)} result(s) for "{escape(query)}" ({elapsed:.1f} ms)[/#7289DA]')
+        for channel_id, timestamp, username, content in results:
+            date = timestamp.replace('T', ' - ').split('.')[0]
+            channel = escape(channels.get(channel_id, channel_id))
+            content = escape(content).replace(
+                HIGHLIGHT_START, '[reverse]').replace(HIGHLIGHT_END, '[/reverse]')
+            rprint(
+                f'[bold][blue][{date}][/blue] [#E01E5A]{channel}[/#E01E5A] '
+                f'[magenta]{username}[/magenta][/bold] : {content}')
 
     def send_message(self, content, attachments=[]):
         """
-        The `send_message` function sends a message to a specified channel using the
+        The `send_message` function sends a message to the current channel, through the
+        daemon if one is attached.
+
+        :param content: Message content that you want to send.
+
+        :return: the JSON response from the API call.
+        """
+
+        if self.daemon:
+            # The daemon pushes the sent message right away, no need to refresh
+            return self.daemon.request(
+                'send', channel=self.args.channel, content=content, attachments=attachments
+            )['message']
+
+        message = self.post_message(self.args.channel, content, attachments)
+        # Print the sent message right away, without reprinting the whole window
+        self.update_messages(self.get_messages())
+
+        return message
+
+    def post_message(self, channel, content, attachments=[]):
+        """
+        The `post_message` function sends a message to a specified channel using the
         Discord API.
 
+        :param channel: Unique identifier of the channel.
         :param content: Message content that you want to send.
 
         :return: the JSON response from the API call.
@@ -305,7 +588,7 @@ class MyClient():
         }
 
         response = requests.post(
-            f'{self.url}/channels/{self.args.channel}/messages',
+            f'{self.url}/channels/{channel}/messages',
             headers=self.headers,
             json=data,
             timeout=5
@@ -315,8 +598,6 @@ class MyClient():
             raise Exception(
                 f'Send message failed : {response.status_code} {response.text}')
 
-        self.refresh_screen()
-
         return response.json()
 
     def get_username_from_id(self, user_id):
@@ -330,6 +611,9 @@ class MyClient():
         code is 200. Otherwise, it returns the user_id itself.
         """
 
+        if self.daemon:
+            return self.daemon.request('user', user_id=user_id)['username']
+
         response = requests.get(
             f'{self.url}/users/{user_id}',
             headers=self.headers,
@@ -587,11 +871,16 @@ class MyClient():
         """ Refresh the screen and print the last messages """
 
         os.system('clear') if os.name == 'posix' else os.system('cls')
-        self.messages = []
-        new_messages = self.get_messages()
-        diff_messages = self.diff_messages(new_messages, self.messages)
-        self.print_messages(diff_messages)
-        self.messages = new_messages
+        with self.buffers_lock:
+            self.messages = self.get_buffer(self.args.channel)
+            self.messages.clear()
+
+        if self.daemon:
+            # The daemon answers with its buffer, which the main loop prints
+            self.daemon.request('subscribe', channel=self.args.channel)
+            return
+
+        self.update_messages(self.get_messages())
 
     def internal_command(self, command):
         """
@@ -613,6 +902,9 @@ class MyClient():
                    '| :li - List Guilds & Chan.|\n'
                    '| :fr - List Friends    |\n'
                    '| :we - Print welcome message|\n'
+                   '| :search - Search messages  |\n'
+                   '| :cache - Cache statistics  |\n'
+                   '| :dl - Download attachment  |\n'
                    '=============================='
                    '[/#7289DA]'
                    )
@@ -644,29 +936,30 @@ class MyClient():
         elif command == ':we':
             self.print_welcome()
 
+        elif command.startswith(':search:'):
+            self.search_messages(command[len(':search:'):])
+
+        elif command == ':cache':
+            self.print_cache_stats()
+
+        elif command.startswith(':dl:'):
+            self.download_original(command[len(':dl:'):])
+
         elif command == ':li':
             rprint('\n[#7289DA]' +
                    '=================================================================================\n' +
                    self.rprint_guilds()
                    )
 
-            self.args.channel = input('Channel ID: ')
+            channel = input('Channel ID: ')
             try:
-                int(self.args.channel)
+                int(channel)
             except ValueError:
                 self.kill_thread = True
                 self.main_loop_thread.join()
                 sys.exit('Channel ID must be an integer')
 
-            if self.running:
-                self.kill_thread = True
-                self.main_loop_thread.join()
-                self.running = False
-
-            self.args.channel = self.list_id[int(self.args.channel)]
-            self.main_loop_thread = threading.Thread(target=self.main_loop)
-            self.main_loop_thread.start()
-            self.refresh_screen()
+            self.switch_channel(self.list_id[int(channel)])
 
         elif command == ':fr':
             rprint('\n[#7289DA]' +
@@ -674,23 +967,28 @@ class MyClient():
                    self.rprint_friends()
                    )
 
-            self.args.channel = input('Channel ID: ')
+            channel = input('Channel ID: ')
             try:
-                int(self.args.channel)
+                int(channel)
             except ValueError:
                 self.kill_thread = True
                 self.main_loop_thread.join()
                 sys.exit('Channel ID must be an integer')
 
-            if self.running:
-                self.kill_thread = True
-                self.main_loop_thread.join()
-                self.running = False
+            self.switch_channel(self.friends[int(channel) - 1]['id'])
 
-            self.args.channel = self.friends[int(self.args.channel) - 1]['id']
-            self.main_loop_thread = threading.Thread(target=self.main_loop)
-            self.main_loop_thread.start()
-            self.refresh_screen()
+    def print_cache_stats(self):
+        """ Print the efficiency of the attachments cache """
+
+        stats = self.attachment_cache.stats()
+        rprint(
+            '[#7289DA]Attachments cache : '
+            f'{stats["hits"]} hit(s), {stats["misses"]} miss(es) '
+            f'({stats["hit_rate"]:.0%} hit rate), '
+            f'{stats["bytes_saved"] / 1024 / 1024:.1f} MiB saved, '
+            f'{stats["files"]} file(s) using {stats["bytes"] / 1024 / 1024:.1f} MiB '
+            f'of {self.attachment_cache.max_bytes / 1024 / 1024:.0f} MiB[/#7289DA]'
+        )
 
     def print_welcome(self):
         """ Print the welcome message and the commands list """
@@ -727,33 +1025,103 @@ class MyClient():
                '|   :li - List Guilds & Channels                                                |\n'
                '|   :fr - List Friends                                                          |\n'
                '|   :we - Print welcome message                                                 |\n'
+               '|   :search - Search seen messages (ex: :search:release notes)                  |\n'
+               '|   :cache - Print attachments cache statistics                                 |\n'
+               '|   :dl - Download an original attachment (ex: :dl:<attachment url>)            |\n'
                '=================================================================================[/#7289DA]'
                )
 
+    def switch_channel(self, channel):
+        """
+        The switch_channel function stops the main loop and opens another channel. The
+        messages already buffered for the channel, usually prefetched, are printed right
+        away, then the main loop fetches the channel once to catch up.
+
+        :param channel: Unique identifier of the channel to open.
+        """
+
+        if self.running:
+            self.kill_thread = True
+            self.main_loop_thread.join()
+            self.running = False
+
+        if self.args.channel and self.messages.last_id():
+            self.prefetcher.record_seen(self.args.channel, self.messages.last_id())
+
+        self.args.channel = channel
+        self.prefetcher.record_open(channel)
+
+        os.system('clear') if os.name == 'posix' else os.system('cls')
+        with self.buffers_lock:
+            self.messages = self.get_buffer(channel)
+            if self.daemon:
+                # The daemon answers the subscription with its own buffer
+                self.messages.clear()
+            buffered = list(self.messages)
+        # Printed once released, rendering may download attachments and run chafa
+        self.print_messages(buffered)
+
+        self.main_loop_thread = threading.Thread(target=self.main_loop)
+        self.main_loop_thread.start()
+
     def main_loop(self):
         """
         The main_loop function retrieves and prints messages, then continuously checks for new
         messages and prints any differences.
         """
 
-        self.messages = self.get_messages()
-        self.print_messages(self.messages)
+        with self.buffers_lock:
+            self.messages = self.get_buffer(self.args.channel)
         self.kill_thread = False
         self.running = True
 
+        if self.daemon:
+            self.daemon_loop()
+            return
+
+        self.update_messages(self.get_messages())
+
         started = time.time()
         while not self.kill_thread:
             if time.time() - started >= 3:
-                new_messages = self.get_messages()
-                diff_messages = self.diff_messages(new_messages, self.messages)
-                self.print_messages(diff_messages)
-                self.messages = new_messages
+                self.update_messages(self.get_messages())
                 started = time.time()
             else:
                 time.sleep(0.1)
 
+    def daemon_loop(self):
+        """
+        The daemon_loop function subscribes to the current channel and prints the changes
+        pushed by the daemon, until the thread is killed.
+        """
+
+        channel = self.args.channel
+        self.daemon.request('subscribe', channel=channel)
+
+        while not self.kill_thread:
+            update = self.daemon.next_update(timeout=0.1)
+            if update is None:
+                continue
+
+            updated_channel, new, edited, deleted = update
+            if updated_channel is None:
+                rprint('[bold][red]Daemon connection lost[/red][/bold]')
+                return
+            if updated_channel == channel:
+                with self.buffers_lock:
+                    changes = self.messages.apply(new, edited, deleted)
+                self.print_update(*changes)
+
+        self.daemon.request('unsubscribe', channel=channel)
+
     def clean(self):
-        """ Clean the tmp folder """
+        """ Stop prefetching, flush the search index and clean the tmp folder """
+
+        self.prefetcher.stop()
+        if self.args.channel and self.messages.last_id():
+            self.prefetcher.record_seen(self.args.channel, self.messages.last_id())
+        self.search_index.close()
+        self.attachment_cache.close()
 
         for file in os.listdir('./tmp'):
             os.remove(f'./tmp/{file}')
@@ -773,6 +1141,10 @@ class MyClient():
         def query_data():
             """ Query data from Discord API in a thread """
 
+            if self.daemon:
+                # Already fetched by the daemon
+                return
+
             self.list_friends()
             self.rprint_friends()
             self.list_guilds()
@@ -801,6 +1173,9 @@ class MyClient():
             for channel in guild['channels']:
                 self.list_id[channel['local_id']] = channel['id']
 
+        if not self.daemon:
+            self.prefetcher.start()
+
         if not self.args.channel:
             while self.args.channel is None:
                 command = input('What should we do : ')
@@ -809,17 +1184,16 @@ class MyClient():
                 else:
                     self.internal_command(command)
         else:
-            self.main_loop_thread = threading.Thread(target=self.main_loop)
-            self.main_loop_thread.start()
-            self.refresh_screen()
+            self.switch_channel(self.args.channel)
 
-        commands_list = [':q', ':help', ':cr', ':li', ':fr', ':we']
+        commands_list = [':q', ':help', ':cr', ':li', ':fr', ':we', ':cache']
 
         while 1:
             try:
                 time.sleep(1)
                 content = input()
-                if content != '' and ':attach' not in content and content not in commands_list:
+                if content != '' and ':attach' not in content and content not in commands_list \
+                        and not content.startswith((':search:', ':dl:')):
                     message_sent = self.send_message(content)
                 else:
                     self.internal_command(content)
@@ -835,7 +1209,10 @@ def main():
     """ This main function is used to make an entry point for the program."""
 
     client = MyClient()
-    client.main()
+    if client.args.daemon:
+        Daemon(client).serve()
+    else:
+        client.main()
 
 
 if __name__ == "__main__":
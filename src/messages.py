@@ -0,0 +1,412 @@
+# -*- coding: utf-8 -*-
+# --------------------------------------------------
+# messages.py - Compact message model and bounded caches for 10cord.
+# Quentin Dufournet, 2023
+# --------------------------------------------------
+# Built-in
+import json
+from typing import List, Optional
+from collections import OrderedDict, deque
+from urllib.parse import urlsplit, urlunsplit, parse_qsl, urlencode
+
+# Optional, faster JSON backends
+try:
+    import msgspec
+except ImportError:
+    msgspec = None
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+# --------------------------------------------------
+
+MESSAGE_BUFFER_SIZE = 200
+CHANNEL_BUFFER_COUNT = 32
+USER_CACHE_SIZE = 1024
+ATTACHMENT_CACHE_SIZE = 1024
+RENDER_CACHE_SIZE = 1024
+
+
+class Attachment():
+    """ Attachment fields used by the renderer """
+
+    __slots__ = ('url', 'filename', 'proxy_url', 'content_type', 'width', 'height')
+
+    def __init__(self, url, filename, proxy_url=None, content_type=None,
+                 width=None, height=None):
+        self.url = url
+        self.filename = filename
+        self.proxy_url = proxy_url
+        self.content_type = content_type
+        self.width = width
+        self.height = height
+
+    @classmethod
+    def from_dict(cls, data):
+        """
+        The function `from_dict` builds an attachment from a Discord API attachment object.
+
+        :param data: The `data` parameter is a dict that represents the attachment object
+        :return: an `Attachment` instance.
+        """
+
+        return cls(
+            data['url'],
+            data['filename'],
+            data.get('proxy_url'),
+            data.get('content_type'),
+            data.get('width'),
+            data.get('height')
+        )
+
+    def to_dict(self):
+        """
+        The function `to_dict` encodes the attachment like the Discord API does.
+
+        :return: a dict that represents the attachment object.
+        """
+
+        return {slot: getattr(self, slot) for slot in self.__slots__}
+
+    def preview_url(self, max_width, max_height):
+        """
+        The function `preview_url` returns the URL of a preview of the attachment,
+        resized by Discord's media proxy to fit in the given box. Videos are previewed by
+        their first frame.
+
+        :param max_width: The maximum width of the preview, in pixels
+        :param max_height: The maximum height of the preview, in pixels
+        :return: the URL of the preview, or None if the attachment is neither an image
+        nor a video.
+        """
+
+        content_type = self.content_type or ''
+        if not content_type.startswith(('image/', 'video/')) or not self.proxy_url:
+            return None
+
+        params = parse_qsl(urlsplit(self.proxy_url).query)
+
+        if self.width and self.height:
+            # Keep the aspect ratio, and never upscale
+            ratio = min(max_width / self.width, max_height / self.height, 1)
+            params += [('width', str(max(1, int(self.width * ratio)))),
+                       ('height', str(max(1, int(self.height * ratio))))]
+
+        if content_type.startswith('video/'):
+            params.append(('format', 'jpeg'))
+
+        return urlunsplit(urlsplit(self.proxy_url)._replace(query=urlencode(params)))
+
+    def __eq__(self, other):
+        if not isinstance(other, Attachment):
+            return NotImplemented
+        return all(getattr(self, slot) == getattr(other, slot) for slot in self.__slots__)
+
+
+class Message():
+    """ Message fields used by the renderer, decoded from a Discord API message object """
+
+    __slots__ = (
+        'id', 'channel_id', 'timestamp', 'edited_timestamp',
+        'author_id', 'username', 'content', 'attachments', 'referenced', 'deleted'
+    )
+
+    def __init__(self, id, channel_id, timestamp, edited_timestamp,
+                 author_id, username, content, attachments=(), referenced=None,
+                 deleted=False):
+        self.id = id
+        self.channel_id = channel_id
+        self.timestamp = timestamp
+        self.edited_timestamp = edited_timestamp
+        self.author_id = author_id
+        self.username = username
+        self.content = content
+        self.attachments = attachments
+        self.referenced = referenced
+        self.deleted = deleted
+
+    @classmethod
+    def from_dict(cls, data):
+        """
+        The function `from_dict` decodes a Discord API message object, keeping only the
+        fields 10cord renders. The referenced message, if any, is decoded one level deep.
+
+        :param data: The `data` parameter is a dict that represents the message object
+        :return: a `Message` instance.
+        """
+
+        referenced = data.get('referenced_message')
+
+        return cls(
+            data['id'],
+            data.get('channel_id'),
+            data['timestamp'],
+            data.get('edited_timestamp'),
+            data['author']['id'],
+            data['author']['username'],
+            data['content'],
+            tuple(Attachment.from_dict(attachment)
+                  for attachment in data.get('attachments', ())),
+            cls.from_dict(referenced) if referenced else None
+        )
+
+    def to_dict(self):
+        """
+        The function `to_dict` encodes the message like the Discord API does, with only
+        the fields 10cord renders, so that `from_dict` can decode it back.
+
+        :return: a dict that represents the message object.
+        """
+
+        return {
+            'id': self.id,
+            'channel_id': self.channel_id,
+            'timestamp': self.timestamp,
+            'edited_timestamp': self.edited_timestamp,
+            'author': {'id': self.author_id, 'username': self.username},
+            'content': self.content,
+            'attachments': [attachment.to_dict() for attachment in self.attachments],
+            'referenced_message': self.referenced.to_dict() if self.referenced else None,
+        }
+
+    def __eq__(self, other):
+        if not isinstance(other, Message):
+            return NotImplemented
+        return all(getattr(self, slot) == getattr(other, slot) for slot in self.__slots__)
+
+    def update(self, other):
+        """
+        The function `update` copies the fields of an edited version of the message in
+        place, so every reference to the message sees the edit.
+
+        :param other: The `other` parameter is the edited `Message`
+        """
+
+        for slot in self.__slots__:
+            setattr(self, slot, getattr(other, slot))
+
+
+if msgspec is not None:
+    # Typed payload structures, msgspec only decodes the declared fields and skips
+    # embeds, components, reactions and the rest of the author object.
+    class _RawAuthor(msgspec.Struct):
+        id: str
+        username: str
+
+    class _RawAttachment(msgspec.Struct):
+        url: str
+        filename: str
+        proxy_url: Optional[str] = None
+        content_type: Optional[str] = None
+        width: Optional[int] = None
+        height: Optional[int] = None
+
+    class _RawMessage(msgspec.Struct):
+        id: str
+        timestamp: str
+        author: _RawAuthor
+        content: str
+        channel_id: Optional[str] = None
+        edited_timestamp: Optional[str] = None
+        attachments: List[_RawAttachment] = []
+        referenced_message: Optional['_RawMessage'] = None
+
+    _messages_decoder = msgspec.json.Decoder(List[_RawMessage])
+
+    def _from_raw(raw):
+        """
+        The function `_from_raw` converts a msgspec message structure into a `Message`.
+
+        :param raw: The `raw` parameter is a `_RawMessage`
+        :return: a `Message` instance.
+        """
+
+        return Message(
+            raw.id,
+            raw.channel_id,
+            raw.timestamp,
+            raw.edited_timestamp,
+            raw.author.id,
+            raw.author.username,
+            raw.content,
+            tuple(Attachment(attachment.url, attachment.filename, attachment.proxy_url,
+                             attachment.content_type, attachment.width, attachment.height)
+                  for attachment in raw.attachments),
+            _from_raw(raw.referenced_message) if raw.referenced_message else None
+        )
+
+    JSON_BACKEND = 'msgspec'
+elif orjson is not None:
+    JSON_BACKEND = 'orjson'
+else:
+    JSON_BACKEND = 'json'
+
+
+def decode_messages(payload):
+    """
+    The function `decode_messages` decodes a raw Discord API messages payload into
+    `Message` instances, using the fastest available JSON backend: msgspec, then
+    orjson, then the standard library.
+
+    :param payload: The `payload` parameter is the body of the response, as bytes
+    :return: a list of `Message`, in the order of the payload.
+    """
+
+    if JSON_BACKEND == 'msgspec':
+        return [_from_raw(raw) for raw in _messages_decoder.decode(payload)]
+
+    loads = orjson.loads if JSON_BACKEND == 'orjson' else json.loads
+    return [Message.from_dict(message) for message in loads(payload)]
+
+
+class MessageBuffer():
+    """ Fixed-capacity ring buffer holding the latest messages of a channel, indexed by ID """
+
+    def __init__(self, capacity=MESSAGE_BUFFER_SIZE):
+        self.messages = deque(maxlen=capacity)
+        self.index = {}
+
+    def __iter__(self):
+        return iter(self.messages)
+
+    def __len__(self):
+        return len(self.messages)
+
+    def __contains__(self, message):
+        return message.id in self.index
+
+    def get(self, message_id):
+        """
+        The function `get` returns the buffered message with the given ID.
+
+        :param message_id: Unique identifier of a message.
+        :return: the `Message`, or None if it is not buffered.
+        """
+
+        return self.index.get(message_id)
+
+    def last_id(self):
+        """
+        The function `last_id` returns the ID of the newest buffered message.
+
+        :return: the ID, or None if the buffer is empty.
+        """
+
+        return self.messages[-1].id if self.messages else None
+
+    def extend(self, messages):
+        """
+        The function `extend` appends messages to the buffer, dropping the oldest ones
+        once the capacity is reached.
+
+        :param messages: A list of messages, oldest first
+        """
+
+        for message in messages:
+            if len(self.messages) == self.messages.maxlen:
+                del self.index[self.messages.popleft().id]
+            self.messages.append(message)
+            self.index[message.id] = message
+
+    def reconcile(self, messages):
+        """
+        The function `reconcile` merges a freshly fetched window of messages into the
+        buffer by message ID and `edited_timestamp`. Buffered messages that are inside
+        the window but missing from it were deleted, and are marked as such.
+
+        :param messages: A list of the latest messages of the channel, oldest first
+        :return: a tuple of the new, edited and deleted messages.
+        """
+
+        new, edited, deleted = [], [], []
+
+        if not messages:
+            return new, edited, deleted
+
+        # Messages older than the newest buffered one and missing from the index were
+        # evicted from the ring buffer, they are not new.
+        newest = int(self.messages[-1].id) if self.messages else -1
+        fetched_ids = set()
+        for message in messages:
+            fetched_ids.add(message.id)
+            known = self.index.get(message.id)
+            if known is None:
+                if int(message.id) > newest:
+                    new.append(message)
+            elif known.edited_timestamp != message.edited_timestamp:
+                known.update(message)
+                edited.append(known)
+
+        oldest = int(messages[0].id)
+        for message in self.messages:
+            if not message.deleted and message.id not in fetched_ids and int(message.id) >= oldest:
+                message.deleted = True
+                deleted.append(message)
+
+        self.extend(new)
+
+        return new, edited, deleted
+
+    def apply(self, new, edited, deleted):
+        """
+        The function `apply` merges changes already reconciled elsewhere, like the ones
+        pushed by the daemon, into the buffer.
+
+        :param new: A list of new `Message`, oldest first
+        :param edited: A list of edited `Message`
+        :param deleted: A list of IDs of deleted messages
+        :return: a tuple of the new, edited and deleted messages that were not already
+        known by the buffer.
+        """
+
+        new = [message for message in new if message.id not in self.index]
+        self.extend(new)
+
+        applied_edits = []
+        for message in edited:
+            known = self.index.get(message.id)
+            if known is not None and known.edited_timestamp != message.edited_timestamp:
+                known.update(message)
+                applied_edits.append(known)
+
+        applied_deletions = []
+        for message_id in deleted:
+            known = self.index.get(message_id)
+            if known is not None and not known.deleted:
+                known.deleted = True
+                applied_deletions.append(known)
+
+        return new, applied_edits, applied_deletions
+
+    def clear(self):
+        """ Remove every message from the buffer """
+
+        self.messages.clear()
+        self.index.clear()
+
+
+class BoundedDict(OrderedDict):
+    """ Dict keeping at most `capacity` entries, evicting the least recently used one """
+
+    def __init__(self, capacity):
+        super().__init__()
+        self.capacity = capacity
+
+    def __getitem__(self, key):
+        value = super().__getitem__(key)
+        self.move_to_end(key)
+        return value
+
+    def get(self, key, default=None):
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+    def __setitem__(self, key, value):
+        super().__setitem__(key, value)
+        self.move_to_end(key)
+        if len(self) > self.capacity:
+            self.popitem(last=False)
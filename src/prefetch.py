@@ -0,0 +1,196 @@
+# -*- coding: utf-8 -*-
+# --------------------------------------------------
+# prefetch.py - Background prefetch of the channels likely to be opened next.
+# Quentin Dufournet, 2023
+# --------------------------------------------------
+# Built-in
+import os
+import json
+import math
+import time
+import threading
+
+# --------------------------------------------------
+
+PREFETCH_COUNT = 5
+PREFETCH_INTERVAL = 2
+PREFETCH_TTL = 60
+RATE_LIMIT_BACKOFF = 30
+DISCORD_EPOCH = 1420070400000
+
+
+def snowflake_time(snowflake):
+    """
+    The function `snowflake_time` returns the creation time of a Discord ID.
+
+    :param snowflake: The `snowflake` parameter is a Discord ID
+    :return: the creation time, in seconds since the epoch.
+    """
+
+    return ((int(snowflake) >> 22) + DISCORD_EPOCH) / 1000
+
+
+def score_channel(history, last_message_id, now):
+    """
+    The function `score_channel` estimates how likely a channel is to be opened next,
+    from how often and how recently it was opened, and from its unread activity.
+
+    :param history: The usage history of the channel, or None if it was never opened
+    :param last_message_id: ID of the last message of the channel, if any
+    :param now: The current time, in seconds since the epoch
+    :return: the score of the channel, higher is likelier.
+    """
+
+    score = 0
+    seen = 0
+
+    if history:
+        score += math.log1p(history['opens'])
+        score += math.exp(-(now - history['opened']) / 86400)
+        seen = int(history.get('seen', 0))
+
+    if last_message_id and int(last_message_id) > seen:
+        score += math.exp(-(now - snowflake_time(last_message_id)) / 3600)
+
+    return score
+
+
+class Prefetcher():
+    """
+    Fetches the latest messages of the channels most likely to be opened next into
+    their buffers, in a background thread, with at most one request per interval.
+    """
+
+    def __init__(self, client):
+        self.client = client
+        self.path = os.path.join(client.args.cache_dir, 'history.json')
+        self.fetched = {}
+        self.last_ids = {}
+        self.unavailable = set()
+        self.stopped = threading.Event()
+
+        try:
+            with open(self.path, 'r', encoding='utf-8') as f:
+                self.history = json.load(f)
+        except (OSError, ValueError):
+            self.history = {}
+
+        self.thread = threading.Thread(target=self.prefetch_loop, daemon=True)
+
+    def save(self):
+        """ Save the usage history, atomically as other 10cord may be running """
+
+        temporary = f'{self.path}.{os.getpid()}'
+        with open(temporary, 'w', encoding='utf-8') as f:
+            json.dump(self.history, f, indent=4)
+        os.replace(temporary, self.path)
+
+    def record_open(self, channel):
+        """
+        The function `record_open` records that a channel was opened.
+
+        :param channel: Unique identifier of the channel.
+        """
+
+        history = self.history.setdefault(channel, {'opens': 0})
+        history['opens'] += 1
+        history['opened'] = time.time()
+        self.save()
+
+    def record_seen(self, channel, message_id):
+        """
+        The function `record_seen` records the last message read in a channel.
+
+        :param channel: Unique identifier of the channel.
+        :param message_id: ID of the last message read.
+        """
+
+        history = self.history.setdefault(channel, {'opens': 0, 'opened': 0})
+        if int(message_id) > int(history.get('seen', 0)):
+            history['seen'] = message_id
+            self.save()
+
+    def candidates(self):
+        """
+        The function `candidates` ranks the channels the user has access to.
+
+        :return: the IDs of the channels likeliest to be opened next, best first.
+        """
+
+        channels = [(friend['id'], friend.get('last_message_id'))
+                    for friend in self.client.friends]
+        for guild in self.client.guilds:
+            channels += [(channel['id'], channel.get('last_message_id'))
+                         for channel in guild.get('channels', [])]
+
+        # The metadata is fetched once, the prefetched messages are more recent
+        now = time.time()
+        scores = [
+            (score_channel(self.history.get(channel),
+                           self.last_ids.get(channel, last_message_id), now), channel)
+            for channel, last_message_id in channels
+            if channel != self.client.args.channel and channel not in self.unavailable
+        ]
+        scores.sort(reverse=True)
+
+        return [channel for score, channel in scores[:PREFETCH_COUNT] if score > 0]
+
+    def prefetch(self, channel):
+        """
+        The function `prefetch` fetches the latest messages of a channel into its buffer.
+
+        :param channel: Unique identifier of the channel.
+        """
+
+        messages = self.client.get_messages(channel)
+
+        with self.client.buffers_lock:
+            if channel == self.client.args.channel:
+                # Opened while fetching, the main loop owns its buffer and prints it
+                return
+            new, edited, deleted = self.client.get_buffer(channel).reconcile(messages)
+
+        self.client.search_index.add(new + edited)
+        self.client.search_index.remove(deleted)
+        self.fetched[channel] = time.time()
+        if messages:
+            self.last_ids[channel] = messages[-1].id
+
+    def prefetch_next(self):
+        """ Prefetch the best stale candidate, if any """
+
+        stale = [channel for channel in self.candidates()
+                 if time.time() - self.fetched.get(channel, 0) > PREFETCH_TTL]
+        if not stale:
+            return
+
+        try:
+            self.prefetch(stale[0])
+        except Exception as e:
+            # `APIError` of `get_messages`, other errors have no status code
+            status_code = getattr(e, 'status_code', None)
+            if status_code == 429:
+                self.stopped.wait(RATE_LIMIT_BACKOFF)
+            elif status_code in (403, 404):
+                # No access to the channel, it will never be opened
+                self.unavailable.add(stale[0])
+            else:
+                self.fetched[stale[0]] = time.time()
+
+    def prefetch_loop(self):
+        """ Prefetch the stale candidates, one request per interval, until stopped """
+
+        while not self.stopped.wait(PREFETCH_INTERVAL):
+            self.prefetch_next()
+
+    def start(self):
+        """ Start prefetching in the background """
+
+        self.thread.start()
+
+    def stop(self):
+        """ Stop prefetching """
+
+        self.stopped.set()
+        if self.thread.is_alive():
+            self.thread.join()
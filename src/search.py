@@ -0,0 +1,149 @@
+# -*- coding: utf-8 -*-
+# --------------------------------------------------
+# search.py - Local full-text index of the messages seen by 10cord.
+# Quentin Dufournet, 2023
+# --------------------------------------------------
+# Built-in
+import queue
+import sqlite3
+import threading
+
+# 3rd party
+from rich import print as rprint
+
+# --------------------------------------------------
+
+HIGHLIGHT_START = '\x02'
+HIGHLIGHT_END = '\x03'
+
+
+class SearchIndex():
+    """
+    SQLite FTS5 index of messages. Writes are queued and applied by a background
+    thread, so indexing never blocks the rendering of messages.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.queue = queue.Queue()
+
+        connection = self.connect()
+        connection.execute(
+            'CREATE VIRTUAL TABLE IF NOT EXISTS messages USING fts5('
+            'content, username, channel_id UNINDEXED, timestamp UNINDEXED, '
+            'tokenize="unicode61 remove_diacritics 2")'
+        )
+        connection.commit()
+        connection.close()
+
+        self.thread = threading.Thread(target=self.index_loop, daemon=True)
+        self.thread.start()
+
+    def connect(self):
+        """
+        The function `connect` opens a connection to the index. Several 10cord processes
+        can share the same index.
+
+        :return: a `sqlite3.Connection`.
+        """
+
+        connection = sqlite3.connect(self.path, timeout=10)
+        connection.execute('PRAGMA journal_mode=WAL')
+
+        return connection
+
+    def add(self, messages):
+        """
+        The function `add` queues messages to be indexed, or re-indexed if they were
+        edited.
+
+        :param messages: A list of `Message`
+        """
+
+        if messages:
+            self.queue.put(('add', [
+                (int(message.id), message.content, message.username,
+                 message.channel_id, message.timestamp)
+                for message in messages
+            ]))
+
+    def remove(self, messages):
+        """
+        The function `remove` queues deleted messages to be removed from the index.
+
+        :param messages: A list of `Message`
+        """
+
+        if messages:
+            self.queue.put(('remove', [(int(message.id),) for message in messages]))
+
+    def index_loop(self):
+        """
+        The function `index_loop` applies the queued writes, batching everything queued
+        since the last write into a single transaction.
+        """
+
+        connection = self.connect()
+        running = True
+
+        while running:
+            operations = [self.queue.get()]
+            while not self.queue.empty():
+                operations.append(self.queue.get())
+
+            if None in operations:
+                running = False
+                operations = operations[:operations.index(None)]
+
+            try:
+                with connection:
+                    for action, rows in operations:
+                        if action == 'add':
+                            connection.executemany(
+                                'INSERT OR REPLACE INTO messages'
+                                '(rowid, content, username, channel_id, timestamp) '
+                                'VALUES (?, ?, ?, ?, ?)',
+                                rows
+                            )
+                        else:
+                            connection.executemany(
+                                'DELETE FROM messages WHERE rowid = ?', rows
+                            )
+            except sqlite3.Error as e:
+                # Index locked by another 10cord for too long, or disk full: the batch
+                # is dropped, the following ones are still indexed
+                rprint(f'[bold][red]Search index update failed : {e}[/red][/bold]')
+
+        connection.close()
+
+    def search(self, query, limit=20):
+        """
+        The function `search` returns the messages matching every word of the query,
+        best matches first. Matched words are wrapped in `HIGHLIGHT_START` and
+        `HIGHLIGHT_END`.
+
+        :param query: The `query` parameter is the text to search for
+        :param limit: The maximum number of results
+        :return: a list of (channel_id, timestamp, username, content) tuples.
+        """
+
+        terms = ' '.join('"' + term.replace('"', '""') + '"' for term in query.split())
+        if not terms:
+            return []
+
+        connection = self.connect()
+        try:
+            return connection.execute(
+                'SELECT channel_id, timestamp, username, '
+                'highlight(messages, 0, ?, ?) FROM messages '
+                'WHERE messages MATCH ? ORDER BY rank LIMIT ?',
+                (HIGHLIGHT_START, HIGHLIGHT_END, terms, limit)
+            ).fetchall()
+        finally:
+            connection.close()
+
+    def close(self):
+        """ Apply the pending writes and stop the indexing thread """
+
+        self.queue.put(None)
+        self.thread.join()
@@ -0,0 +1,742 @@
+# -*- coding: utf-8 -*-
+# --------------------------------------------------
+# test_10cord.py - Tests of 10cord.
+# Quentin Dufournet, 2023
+# --------------------------------------------------
+# Built-in
+import os
+import sys
+import json
+import time
+import sqlite3
+import argparse
+import threading
+from urllib.parse import urlsplit, parse_qsl
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+# 3rd party
+import pytest  # noqa: E402
+
+# Local
+from src import messages as messages_module  # noqa: E402
+from src.messages import (  # noqa: E402
+    Attachment, Message, MessageBuffer, BoundedDict, decode_messages
+)
+from src.cache import AttachmentCache, url_key  # noqa: E402
+from src.daemon import encode_snapshot  # noqa: E402
+from src.search import SearchIndex, HIGHLIGHT_START, HIGHLIGHT_END  # noqa: E402
+from src.main import MyClient, APIError  # noqa: E402
+from src.prefetch import (  # noqa: E402
+    Prefetcher, score_channel, snowflake_time, DISCORD_EPOCH, RATE_LIMIT_BACKOFF
+)
+from benchmarks.bench_messages import fake_message  # noqa: E402
+
+# --------------------------------------------------
+
+
+def make_message(number, content=None, edited_timestamp=None):
+    """
+    The function `make_message` builds a message with an ID growing with its number.
+
+    :param number: The number of the message
+    :param content: The content of the message
+    :param edited_timestamp: The edition time of the message, if edited
+    :return: a `Message` instance.
+    """
+
+    return Message(
+        str(1100000000000000000 + number),
+        '1089226813218439210',
+        '2023-09-12T15:04:01.516000+00:00',
+        edited_timestamp,
+        '80351110224678912',
+        'user',
+        content if content is not None else f'Message number {number}',
+    )
+
+
+def ids(messages):
+    """
+    The function `ids` returns the numbers of messages built by `make_message`.
+
+    :param messages: A list of `Message`
+    :return: the list of numbers.
+    """
+
+    return [int(message.id) - 1100000000000000000 for message in messages]
+
+
+def test_reconcile_new_messages():
+    buffer = MessageBuffer()
+
+    new, edited, deleted = buffer.reconcile([make_message(i) for i in range(1, 4)])
+    assert ids(new) == [1, 2, 3]
+    assert edited == deleted == []
+
+    new, edited, deleted = buffer.reconcile([make_message(i) for i in range(1, 6)])
+    assert ids(new) == [4, 5]
+    assert edited == deleted == []
+    assert ids(buffer) == [1, 2, 3, 4, 5]
+
+
+def test_reconcile_unchanged_window():
+    buffer = MessageBuffer()
+    buffer.reconcile([make_message(i) for i in range(1, 4)])
+
+    assert buffer.reconcile([make_message(i) for i in range(1, 4)]) == ([], [], [])
+
+
+def test_reconcile_edited_message():
+    buffer = MessageBuffer()
+    buffer.reconcile([make_message(i) for i in range(1, 4)])
+    known = buffer.get(make_message(2).id)
+
+    window = [make_message(1), make_message(2, 'Edited', '2023-09-12T16:00:00'),
+              make_message(3)]
+    new, edited, deleted = buffer.reconcile(window)
+
+    assert new == deleted == []
+    assert edited == [known]
+    assert known.content == 'Edited'
+    assert known.edited_timestamp == '2023-09-12T16:00:00'
+    assert buffer.reconcile(window) == ([], [], [])
+
+
+def test_reconcile_deleted_message():
+    buffer = MessageBuffer()
+    buffer.reconcile([make_message(i) for i in range(1, 5)])
+
+    new, edited, deleted = buffer.reconcile([make_message(i) for i in (1, 2, 4)])
+
+    assert new == edited == []
+    assert ids(deleted) == [3]
+    assert deleted[0].deleted
+    assert ids(buffer) == [1, 2, 3, 4]
+    assert buffer.reconcile([make_message(i) for i in (1, 2, 4)]) == ([], [], [])
+
+
+def test_reconcile_messages_older_than_the_window_are_not_deleted():
+    buffer = MessageBuffer()
+    buffer.reconcile([make_message(i) for i in range(1, 5)])
+
+    new, edited, deleted = buffer.reconcile([make_message(i) for i in range(3, 6)])
+
+    assert ids(new) == [5]
+    assert deleted == []
+
+
+def test_reconcile_evicted_messages_are_not_new():
+    buffer = MessageBuffer(capacity=3)
+    buffer.reconcile([make_message(i) for i in range(1, 6)])
+    assert ids(buffer) == [3, 4, 5]
+    assert len(buffer.index) == 3
+
+    new, edited, deleted = buffer.reconcile([make_message(i) for i in range(1, 7)])
+
+    assert ids(new) == [6]
+    assert edited == deleted == []
+    assert ids(buffer) == [4, 5, 6]
+    assert make_message(3).id not in buffer.index
+
+
+def test_reconcile_empty_window():
+    buffer = MessageBuffer()
+    buffer.reconcile([make_message(i) for i in range(1, 4)])
+
+    assert buffer.reconcile([]) == ([], [], [])
+    assert not any(message.deleted for message in buffer)
+
+
+def test_apply():
+    buffer = MessageBuffer()
+    buffer.apply([make_message(i) for i in range(1, 4)], [], [])
+
+    new, edited, deleted = buffer.apply(
+        [make_message(3), make_message(4)],
+        [make_message(1, 'Edited', '2023-09-12T16:00:00')],
+        [make_message(2).id, make_message(99).id]
+    )
+
+    assert ids(new) == [4]
+    assert ids(edited) == [1]
+    assert buffer.get(make_message(1).id).content == 'Edited'
+    assert ids(deleted) == [2]
+    assert buffer.get(make_message(2).id).deleted
+    assert ids(buffer) == [1, 2, 3, 4]
+
+
+def test_apply_ignores_changes_already_known():
+    buffer = MessageBuffer()
+    edit = make_message(1, 'Edited', '2023-09-12T16:00:00')
+    buffer.apply([make_message(1), make_message(2)], [edit], [make_message(2).id])
+
+    assert buffer.apply([make_message(1)], [edit], [make_message(2).id]) == ([], [], [])
+
+
+def search(path, query, *changes):
+    """
+    The function `search` applies changes to the search index, then searches it.
+
+    :param path: Path of the index
+    :param query: The text to search for
+    :param changes: Tuples of the name of a `SearchIndex` method and its messages
+    :return: the contents of the results, best matches first.
+    """
+
+    index = SearchIndex(str(path))
+    for method, messages in changes:
+        getattr(index, method)(messages)
+    index.close()
+
+    return [content for _, _, _, content in index.search(query)]
+
+
+def test_search_index_add_edit_remove(tmp_path):
+    path = tmp_path / 'search.db'
+
+    assert search(path, 'release', ('add', [make_message(1, 'The release is out')])) == [
+        f'The {HIGHLIGHT_START}release{HIGHLIGHT_END} is out']
+
+    # An edit replaces the indexed content
+    edit = make_message(1, 'The launch is out', '2023-09-12T16:00:00')
+    assert search(path, 'release', ('add', [edit])) == []
+    assert search(path, 'launch') == [f'The {HIGHLIGHT_START}launch{HIGHLIGHT_END} is out']
+
+    assert search(path, 'launch', ('remove', [edit])) == []
+
+
+def test_search_index_ranks_and_matches_every_word(tmp_path):
+    messages = [
+        make_message(1, 'Cats and dogs, and birds, and fish, and horses, and cows'),
+        make_message(2, 'Cats and dogs'),
+        make_message(3, 'Only cats'),
+        make_message(4, 'Café with diacritics'),
+    ]
+
+    results = search(tmp_path / 'search.db', 'cats DOGS', ('add', messages))
+
+    assert [content.replace(HIGHLIGHT_START, '').replace(HIGHLIGHT_END, '')
+            for content in results] == [messages[1].content, messages[0].content]
+    assert search(tmp_path / 'search.db', 'cafe') == [
+        f'{HIGHLIGHT_START}Café{HIGHLIGHT_END} with diacritics']
+
+
+@pytest.mark.parametrize('query, expected', [
+    ('"', []),
+    (' ', []),
+    ('*', []),
+    ('NEAR(', []),
+    # Operators and special characters are searched as plain words
+    ('AND', ['Cats {}AND{} dogs, or not']),
+    ('OR NOT', ['Cats AND dogs, {}or{} {}not{}']),
+    ('cats)', ['{}Cats{} AND dogs, or not']),
+    ('cat*', []),
+    ('a"b', ['{}a"b{}']),
+])
+def test_search_index_quotes_queries(tmp_path, query, expected):
+    messages = [make_message(1, 'Cats AND dogs, or not'), make_message(2, 'a"b')]
+    highlights = (HIGHLIGHT_START, HIGHLIGHT_END) * 2
+
+    assert search(tmp_path / 'search.db', query, ('add', messages)) == [
+        result.format(*highlights) for result in expected]
+
+
+def test_search_index_survives_failed_batches(tmp_path, capsys):
+    index = SearchIndex(str(tmp_path / 'search.db'))
+    index.queue.put(('add', [(1, 'Missing columns')]))
+
+    output = ''
+    started = time.time()
+    while 'Search index update failed' not in output and time.time() - started < 5:
+        time.sleep(0.01)
+        output += capsys.readouterr().out
+    assert 'Search index update failed' in output
+    assert index.thread.is_alive()
+
+    index.add([make_message(2, 'Indexed')])
+    index.close()
+    assert len(index.search('indexed')) == 1
+
+
+def test_snapshot_leaves_deleted_messages_out():
+    buffer = MessageBuffer()
+    buffer.reconcile([make_message(i) for i in range(1, 5)])
+    buffer.reconcile([make_message(i) for i in (1, 2, 4)])
+
+    # Sent over the socket, then applied by a frontend starting from an empty buffer
+    event = json.loads(json.dumps(encode_snapshot('1089226813218439210', buffer)))
+    frontend = MessageBuffer()
+    new, edited, deleted = frontend.apply(
+        [Message.from_dict(message) for message in event['new']],
+        [Message.from_dict(message) for message in event['edited']],
+        event['deleted']
+    )
+
+    assert ids(new) == [1, 2, 4]
+    assert edited == deleted == []
+    assert ids(frontend) == [1, 2, 4]
+
+
+def unusual_messages():
+    """
+    The function `unusual_messages` builds messages with the optional fields of the API
+    missing or null.
+
+    :return: a list of dicts that represent message objects.
+    """
+
+    unreferenced = fake_message(1, referenced=False)
+    unreferenced['referenced_message'] = None
+    edited = fake_message(2)
+    edited['edited_timestamp'] = '2023-09-12T16:00:00.000000+00:00'
+    del edited['channel_id']
+    file = fake_message(5)
+    file['attachments'][0].update(width=None, height=None, content_type=None)
+    file['attachments'].append({'url': 'https://cdn.discordapp.com/a.zip', 'filename': 'a.zip'})
+
+    return [unreferenced, edited, file]
+
+
+@pytest.mark.parametrize('backend', [
+    'json',
+    pytest.param('orjson', marks=pytest.mark.skipif(
+        messages_module.orjson is None, reason='orjson is not installed')),
+    pytest.param('msgspec', marks=pytest.mark.skipif(
+        messages_module.msgspec is None, reason='msgspec is not installed')),
+])
+@pytest.mark.parametrize('payload', [
+    [],
+    [fake_message(i) for i in range(1, 21)],
+    unusual_messages(),
+], ids=['empty', 'bench', 'unusual'])
+def test_decode_messages_backends_agree(monkeypatch, backend, payload):
+    monkeypatch.setattr(messages_module, 'JSON_BACKEND', backend)
+
+    decoded = decode_messages(json.dumps(payload).encode())
+
+    assert decoded == [Message.from_dict(message) for message in payload]
+
+
+def test_bounded_dict_evicts_least_recently_used():
+    cache = BoundedDict(2)
+    cache['a'] = 1
+    cache['b'] = 2
+    assert cache['a'] == 1
+
+    cache['c'] = 3
+
+    assert 'b' not in cache
+    assert list(cache) == ['a', 'c']
+    assert cache.get('a') == 1
+    cache['d'] = 4
+    assert list(cache) == ['a', 'd']
+    assert cache.get('c') is None
+
+
+def test_url_key_strips_signature_params():
+    signed = ('https://cdn.discordapp.com/attachments/1/2/cat.png'
+              '?ex=65012345&is=64ffd1c5&hm=abcdef&width=10&height=5')
+    resigned = ('https://cdn.discordapp.com/attachments/1/2/cat.png'
+                '?height=5&hm=012345&width=10&ex=65099999&is=650048c5')
+
+    assert url_key(signed) == 'cdn.discordapp.com/attachments/1/2/cat.png?height=5&width=10'
+    assert url_key(resigned) == url_key(signed)
+    assert url_key('https://cdn.discordapp.com/attachments/1/2/dog.png?ex=1') != url_key(signed)
+
+
+class Downloads():
+    """ Fake download function, counting the URLs it downloads """
+
+    def __init__(self, size=100):
+        self.size = size
+        self.urls = []
+
+    def __call__(self, url):
+        self.urls.append(url)
+        return url.encode().ljust(self.size, b'.')
+
+
+def test_attachment_cache_hits_and_misses(tmp_path):
+    cache = AttachmentCache(str(tmp_path), 1000)
+    download = Downloads()
+
+    path = cache.get('https://cdn.discordapp.com/a.png?ex=1&is=2&hm=3', download)
+    assert cache.get('https://cdn.discordapp.com/a.png?ex=4&is=5&hm=6', download) == path
+    assert cache.get('https://cdn.discordapp.com/b.png', lambda url: None) is None
+
+    with open(path, 'rb') as f:
+        assert f.read() == download('https://cdn.discordapp.com/a.png?ex=1&is=2&hm=3')
+    assert cache.stats() == {
+        'hits': 1, 'misses': 1, 'hit_rate': 0.5, 'bytes_saved': 100, 'files': 1,
+        'bytes': 100,
+    }
+    cache.close()
+
+
+def test_attachment_cache_evicts_least_recently_used(tmp_path):
+    cache = AttachmentCache(str(tmp_path), 250)
+    download = Downloads()
+
+    first = cache.get('https://cdn.discordapp.com/1.png', download)
+    second = cache.get('https://cdn.discordapp.com/2.png', download)
+    cache.get('https://cdn.discordapp.com/1.png', download)
+    third = cache.get('https://cdn.discordapp.com/3.png', download)
+
+    assert os.path.exists(first) and os.path.exists(third)
+    assert not os.path.exists(second)
+    assert cache.stats()['bytes'] == 200
+
+    cache.get('https://cdn.discordapp.com/2.png', download)
+    assert not os.path.exists(first)
+    assert download.urls.count('https://cdn.discordapp.com/2.png') == 2
+    cache.close()
+
+
+def test_attachment_cache_persists_across_reopen(tmp_path):
+    cache = AttachmentCache(str(tmp_path), 1000)
+    path = cache.get('https://cdn.discordapp.com/a.png?ex=1', Downloads())
+    cache.close()
+
+    cache = AttachmentCache(str(tmp_path), 1000)
+    download = Downloads()
+
+    assert cache.get('https://cdn.discordapp.com/a.png?ex=2', download) == path
+    assert download.urls == []
+    assert cache.stats()['hits'] == 1
+    cache.close()
+
+
+def test_attachment_cache_rolls_back_on_error(tmp_path, monkeypatch):
+    cache = AttachmentCache(str(tmp_path), 1000)
+    other = AttachmentCache(str(tmp_path), 1000)
+    evict = cache.evict
+
+    def failing_evict(keep):
+        monkeypatch.setattr(cache, 'evict', evict)
+        raise sqlite3.OperationalError('disk I/O error')
+
+    monkeypatch.setattr(cache, 'evict', failing_evict)
+    with pytest.raises(sqlite3.OperationalError):
+        cache.get('https://cdn.discordapp.com/a.png', Downloads())
+
+    assert not cache.connection.in_transaction
+    assert cache.stats()['files'] == 0
+
+    # Neither this process nor another one sharing the cache is locked out
+    assert cache.get('https://cdn.discordapp.com/a.png', Downloads()) is not None
+    assert other.get('https://cdn.discordapp.com/b.png', Downloads()) is not None
+    assert other.stats()['files'] == 2
+    cache.close()
+    other.close()
+
+
+class Calls():
+    """ Fake function, counting its calls and returning the next of its results """
+
+    def __init__(self, *results):
+        self.results = list(results)
+        self.calls = []
+
+    def __call__(self, *args):
+        self.calls.append(args)
+        return self.results.pop(0) if len(self.results) > 1 else self.results[0]
+
+
+def make_client(tmp_path):
+    """
+    The function `make_client` builds a client without logging in, with its caches in a
+    temporary directory.
+
+    :param tmp_path: The temporary directory
+    :return: a `MyClient` instance.
+    """
+
+    client = MyClient.__new__(MyClient)
+    client.args = argparse.Namespace(attach=True, channel='1089226813218439210')
+    client.ids = BoundedDict(16)
+    client.attachments = BoundedDict(16)
+    client.shown_attachments = BoundedDict(16)
+    client.rendered = BoundedDict(16)
+    client.messages = MessageBuffer()
+    client.attachment_cache = AttachmentCache(str(tmp_path / 'attachments'), 10 ** 6)
+    client.get_username_from_id = Calls('friend')
+    client.download_attachment = Calls(b'preview')
+
+    return client
+
+
+def make_attachment_message(number, edited_timestamp=None):
+    """
+    The function `make_attachment_message` builds a message mentioning a user, with an
+    image attachment.
+
+    :param number: The number of the message
+    :param edited_timestamp: The edition time of the message, if edited
+    :return: a `Message` instance.
+    """
+
+    message = make_message(number, f'<@42> look {edited_timestamp or ""}', edited_timestamp)
+    message.attachments = (Attachment(
+        f'https://cdn.discordapp.com/attachments/1/{number}/cat.png?ex=1',
+        'cat.png',
+        f'https://media.discordapp.net/attachments/1/{number}/cat.png?ex=1',
+        'image/png', 800, 600),)
+
+    return message
+
+
+def test_render_content_is_memoized(tmp_path):
+    client = make_client(tmp_path)
+    message = make_attachment_message(1)
+
+    content = client.render_content(message)
+    assert '@friend' in content and message.attachments[0].url in content
+    assert client.render_content(message) == content
+
+    assert len(client.get_username_from_id.calls) == 1
+    assert len(client.download_attachment.calls) == 1
+    assert client.attachments.get(message.attachments[0].url)
+
+
+def test_render_content_is_renewed_by_an_edit(tmp_path):
+    client = make_client(tmp_path)
+    message = make_attachment_message(1)
+    content = client.render_content(message)
+
+    edited = make_attachment_message(1, '2023-09-12T16:00:00')
+    assert client.render_content(edited) != content
+    assert '2023-09-12T16:00:00' in client.render_content(edited)
+
+
+def test_render_content_retries_failed_previews(tmp_path):
+    client = make_client(tmp_path)
+    client.download_attachment = Calls(None, b'preview')
+    message = make_attachment_message(1)
+
+    client.render_content(message)
+    assert message.attachments[0].url not in client.attachments
+
+    client.render_content(message)
+    assert len(client.download_attachment.calls) == 2
+    assert client.attachments.get(message.attachments[0].url)
+    assert len(client.get_username_from_id.calls) == 1
+
+
+def test_render_content_registers_attachments_for_dl(tmp_path):
+    client = make_client(tmp_path)
+    message = make_attachment_message(1)
+    client.render_content(message)
+
+    client.shown_attachments.clear()
+    client.render_content(message)
+
+    assert client.shown_attachments.get(message.attachments[0].url) is message.attachments[0]
+
+
+def make_snowflake(seconds):
+    """
+    The function `make_snowflake` builds a Discord ID created at a given time.
+
+    :param seconds: The creation time, in seconds since the epoch
+    :return: the ID.
+    """
+
+    return str(int(seconds * 1000 - DISCORD_EPOCH) << 22)
+
+
+class PrefetchClient():
+    """ Fake client of the prefetcher, with one friend and one guild channel """
+
+    def __init__(self, tmp_path, messages):
+        self.args = argparse.Namespace(cache_dir=str(tmp_path), channel=None)
+        self.friends = [{'id': 'friend', 'last_message_id': None}]
+        self.guilds = [{'channels': [{'id': 'guild', 'last_message_id': None}]}]
+        self.buffers = {}
+        self.buffers_lock = threading.Lock()
+        self.search_index = argparse.Namespace(add=Calls(None), remove=Calls(None))
+        self.messages = messages
+
+    def get_messages(self, channel):
+        return self.messages
+
+    def get_buffer(self, channel):
+        return self.buffers.setdefault(channel, MessageBuffer())
+
+
+def test_prefetch_ranks_by_prefetched_activity(tmp_path):
+    now = time.time()
+    active = make_message(1)
+    active.id = make_snowflake(now)
+    client = PrefetchClient(tmp_path, [active])
+    prefetcher = Prefetcher(client)
+
+    # Never opened, and no activity when the metadata was fetched
+    assert prefetcher.candidates() == []
+
+    prefetcher.prefetch('guild')
+
+    assert prefetcher.candidates() == ['guild']
+    assert snowflake_time(prefetcher.last_ids['guild']) == pytest.approx(now, abs=0.01)
+
+
+def test_score_channel():
+    now = time.time()
+    opened = {'opens': 3, 'opened': now - 3600}
+
+    assert score_channel(None, None, now) == 0
+    assert score_channel({'opens': 10, 'opened': now - 3600}, None, now) > \
+        score_channel(opened, None, now)
+    assert score_channel({'opens': 3, 'opened': now}, None, now) > \
+        score_channel(opened, None, now)
+
+    # Unread messages count, the more recent the more
+    recent, old = make_snowflake(now - 60), make_snowflake(now - 86400)
+    assert score_channel(opened, recent, now) > score_channel(opened, old, now) > \
+        score_channel(opened, None, now)
+    assert score_channel(dict(opened, seen=recent), recent, now) == \
+        score_channel(opened, None, now)
+    assert score_channel(None, recent, now) > 0
+
+
+def test_prefetch_leaves_a_channel_opened_during_its_fetch(tmp_path):
+    client = PrefetchClient(tmp_path, [make_message(1)])
+
+    def get_messages(channel):
+        # Opened by the user while its messages were being fetched
+        client.args.channel = channel
+        return client.messages
+
+    client.get_messages = get_messages
+    prefetcher = Prefetcher(client)
+    prefetcher.prefetch('guild')
+
+    assert len(client.get_buffer('guild')) == 0
+    assert client.search_index.add.calls == []
+    assert 'guild' not in prefetcher.fetched
+
+
+@pytest.mark.parametrize('error, unavailable, fetched, backoff', [
+    (APIError('Get messages failed : 429 You are being rate limited.', 429),
+     False, False, True),
+    (APIError('Get messages failed : 403 Missing Access', 403), True, False, False),
+    (APIError('Get messages failed : 404 Unknown Channel', 404), True, False, False),
+    # Only the status code counts, not the wording of the error
+    (APIError('Get messages failed : 500 Error 404 ', 500), False, True, False),
+    (Exception('Connection 429 reset'), False, True, False),
+])
+def test_prefetch_handles_errors_by_status_code(tmp_path, error, unavailable, fetched,
+                                                backoff):
+    client = PrefetchClient(tmp_path, [])
+    client.friends[0]['last_message_id'] = make_snowflake(time.time())
+
+    def get_messages(channel):
+        raise error
+
+    client.get_messages = get_messages
+    prefetcher = Prefetcher(client)
+    prefetcher.stopped = argparse.Namespace(wait=Calls(False))
+    prefetcher.prefetch_next()
+
+    assert ('friend' in prefetcher.unavailable) == unavailable
+    assert ('friend' in prefetcher.fetched) == fetched
+    assert (prefetcher.stopped.wait.calls == [(RATE_LIMIT_BACKOFF,)]) == backoff
+
+
+PROXY_URL = 'https://media.discordapp.net/attachments/1/2/cat.png?ex=65012345&is=64ffd1c5&hm=abcdef'
+
+
+def preview_params(attachment, max_width=400, max_height=800):
+    """
+    The function `preview_params` returns the query parameters of a preview URL.
+
+    :param attachment: The `Attachment` to preview
+    :param max_width: The maximum width of the preview, in pixels
+    :param max_height: The maximum height of the preview, in pixels
+    :return: a dict of the parameters.
+    """
+
+    url = attachment.preview_url(max_width, max_height)
+    assert url.startswith('https://media.discordapp.net/attachments/1/2/cat.png?')
+
+    return dict(parse_qsl(urlsplit(url).query))
+
+
+def test_preview_url_fits_and_keeps_the_aspect_ratio():
+    params = preview_params(Attachment('url', 'cat.png', PROXY_URL, 'image/png', 800, 600))
+
+    assert (params['width'], params['height']) == ('400', '300')
+    assert preview_params(Attachment('url', 'cat.png', PROXY_URL, 'image/png', 600, 1600))[
+        'height'] == '800'
+
+
+def test_preview_url_never_upscales():
+    params = preview_params(Attachment('url', 'cat.png', PROXY_URL, 'image/png', 100, 50))
+
+    assert (params['width'], params['height']) == ('100', '50')
+
+
+def test_preview_url_keeps_signature_params():
+    params = preview_params(Attachment('url', 'cat.png', PROXY_URL, 'image/png', 800, 600))
+
+    assert (params['ex'], params['is'], params['hm']) == ('65012345', '64ffd1c5', 'abcdef')
+
+
+def test_preview_url_without_size():
+    params = preview_params(Attachment('url', 'cat.png', PROXY_URL, 'image/png'))
+
+    assert 'width' not in params and 'height' not in params
+    assert params['hm'] == 'abcdef'
+
+
+def test_preview_url_of_videos_is_their_first_frame():
+    params = preview_params(Attachment('url', 'cat.mp4', PROXY_URL, 'video/mp4', 1920, 1080))
+
+    assert params['format'] == 'jpeg'
+    assert (params['width'], params['height']) == ('400', '225')
+
+
+@pytest.mark.parametrize('content_type, proxy_url', [
+    ('application/pdf', PROXY_URL),
+    ('text/plain', PROXY_URL),
+    (None, PROXY_URL),
+    ('image/png', None),
+])
+def test_preview_url_of_other_attachments(content_type, proxy_url):
+    attachment = Attachment('url', 'file', proxy_url, content_type, 800, 600)
+
+    assert attachment.preview_url(400, 800) is None
+
+
+def test_download_original_only_downloads_shown_attachments(tmp_path, monkeypatch, capsys):
+    monkeypatch.chdir(tmp_path)
+    client = make_client(tmp_path)
+    client.download_attachment = Calls(b'original')
+    message = make_attachment_message(1)
+
+    client.download_original(message.attachments[0].url)
+    assert 'Unknown attachment' in capsys.readouterr().out
+
+    client.render_content(message)
+    client.download_attachment.calls.clear()
+    client.download_original('https://evil.example.com/cat.png')
+    client.download_original(f' {message.attachments[0].url}\n')
+
+    assert client.download_attachment.calls == [(message.attachments[0].url,)]
+    assert (tmp_path / 'cat.png').read_bytes() == b'original'
+
+
+def test_download_original_never_overwrites(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    (tmp_path / 'cat.png').write_bytes(b'mine')
+    client = make_client(tmp_path)
+    message = make_attachment_message(1)
+    client.render_content(message)
+    client.download_attachment = Calls(b'first', b'second')
+
+    client.download_original(message.attachments[0].url)
+    client.download_original(message.attachments[0].url)
+
+    assert (tmp_path / 'cat.png').read_bytes() == b'mine'
+    assert (tmp_path / 'cat_1.png').read_bytes() == b'first'
+    assert (tmp_path / 'cat_2.png').read_bytes() == b'second'